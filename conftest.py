@@ -0,0 +1,23 @@
+import pytest
+from django.test.utils import override_settings
+
+from core.test_runner import temporary_caches
+
+
+@pytest.fixture(scope='session', autouse=True)
+def temporary_cache_files(tmp_path_factory):
+    '''Файлы кешей SQLite - во временном каталоге, см. core.test_runner.'''
+    directory = tmp_path_factory.mktemp('caches')
+    with override_settings(CACHES=temporary_caches(str(directory))):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def inline_image_workers(settings):
+    '''
+    Картинки и миниатюры обрабатываются сразу, в потоке теста:
+    пулы пишут в БД из своих потоков, а тестовая SQLite в памяти
+    блокирует общие таблицы целиком.
+    '''
+    settings.IMAGE_INGEST_WORKERS = 0
+    settings.THUMBNAIL_WORKERS = 0
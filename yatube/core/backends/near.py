@@ -0,0 +1,244 @@
+'''
+Ближний кеш процесса перед общим кешем.
+
+Даже из общего кеша (core.backends.sqlite) каждое чтение - это
+запрос к файлу и распаковка записи. NearCache держит недавно
+прочитанные записи в памяти процесса (LRU на MAX_ENTRIES записей,
+не дольше LOCAL_TIMEOUT секунд) и ходит в общий кеш LOCATION
+только за остальными.
+
+Сброс версий (core.cache.bump_versions вызывает bump_generation)
+и clear() увеличивают счетчик-поколение в общем кеше. Раз
+в STAMP_INTERVAL секунд процесс сверяет его со своим и при
+расхождении очищает ближний кеш целиком. Так сброс версий из
+обработчиков сигналов в одном воркере доходит до остальных
+не позже чем через STAMP_INTERVAL секунд.
+
+Остальные записи поколение не меняют: страницы и фрагменты лежат
+под ключами с версиями, блокировки идут мимо ближнего кеша, а
+прочее другие процессы увидят не позже чем через LOCAL_TIMEOUT.
+Иначе каждая запись очищала бы ближние кеши всех процессов.
+
+Строки, байты и числа хранятся как есть, остальное - в pickle:
+ответы и другие изменяемые объекты нельзя отдавать двум запросам.
+'''
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+GENERATION_KEY = 'near_cache.generation'
+
+# Значения, которые можно отдавать без копирования
+IMMUTABLE_TYPES = (str, bytes, int, float, bool, type(None))
+
+# Ближние кеши процесса по LOCATION, общие для всех потоков
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class _LocalStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.generation = None
+        self.checked_at = float('-inf')
+        self.hits = 0
+        self.misses = 0
+
+
+class NearCache(BaseCache):
+    '''
+    CACHES = {
+        'default': {
+            'BACKEND': 'core.backends.near.NearCache',
+            'LOCATION': 'shared',
+        },
+        'shared': {...},
+    }
+    OPTIONS: MAX_ENTRIES, LOCAL_TIMEOUT и STAMP_INTERVAL (сек.).
+    TIMEOUT и KEY_PREFIX задаются у общего кеша.
+    '''
+
+    def __init__(self, location: str, params: dict):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._target_alias = location
+        self._local_timeout = float(options.get('LOCAL_TIMEOUT', 5))
+        self._stamp_interval = float(options.get('STAMP_INTERVAL', 1))
+        with _stores_lock:
+            self._store = _stores.setdefault(location, _LocalStore())
+
+    @property
+    def _target(self) -> BaseCache:
+        return caches[self._target_alias]
+
+    def _local_key(self, key, version) -> str:
+        return self._target.make_key(key, version=version)
+
+    def _check_generation(self) -> None:
+        '''Не чаще раза в STAMP_INTERVAL сверяем поколение с общим.'''
+
+        store = self._store
+        now = time.monotonic()
+        if now - store.checked_at < self._stamp_interval:
+            return
+        generation = self._target.get(GENERATION_KEY, 0)
+        with store.lock:
+            if generation != store.generation:
+                store.data.clear()
+                store.generation = generation
+            store.checked_at = now
+
+    def bump_generation(self) -> None:
+        '''Ближние кеши других процессов устарели, см. описание модуля.'''
+
+        target = self._target
+        try:
+            generation = target.incr(GENERATION_KEY)
+        except ValueError:
+            if target.add(GENERATION_KEY, 1, None):
+                generation = 1
+            else:
+                generation = target.incr(GENERATION_KEY)
+        store = self._store
+        with store.lock:
+            # свои изменения процесс уже видит, а пропущенные чужие
+            # (поколение ушло дальше, чем на единицу) - нет
+            if store.generation is None or generation != (
+                store.generation + 1
+            ):
+                store.data.clear()
+            store.generation = generation
+
+    def _remember(self, local_key: str, value, timeout=DEFAULT_TIMEOUT):
+        lifetime = self._local_timeout
+        if timeout is not DEFAULT_TIMEOUT and timeout is not None:
+            lifetime = min(lifetime, timeout)
+        if lifetime <= 0:
+            return
+        if not isinstance(value, IMMUTABLE_TYPES):
+            value = _Pickled(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        store = self._store
+        with store.lock:
+            store.data[local_key] = (time.monotonic() + lifetime, value)
+            store.data.move_to_end(local_key)
+            while len(store.data) > self._max_entries:
+                store.data.popitem(last=False)
+
+    def _recall(self, local_key: str):
+        '''Значение из ближнего кеша или _MISSING.'''
+
+        store = self._store
+        with store.lock:
+            entry = store.data.get(local_key)
+            if entry is None or entry[0] <= time.monotonic():
+                store.data.pop(local_key, None)
+                store.misses += 1
+                return _MISSING
+            store.data.move_to_end(local_key)
+            store.hits += 1
+        value = entry[1]
+        if isinstance(value, _Pickled):
+            value = pickle.loads(value)
+        return value
+
+    def _forget(self, local_keys) -> None:
+        with self._store.lock:
+            for local_key in local_keys:
+                self._store.data.pop(local_key, None)
+
+    def get(self, key, default=None, version=None):
+        self._check_generation()
+        local_key = self._local_key(key, version)
+        value = self._recall(local_key)
+        if value is not _MISSING:
+            return value
+        value = self._target.get(key, _MISSING, version=version)
+        if value is _MISSING:
+            return default
+        self._remember(local_key, value)
+        return value
+
+    def get_many(self, keys, version=None):
+        self._check_generation()
+        found, missing = {}, []
+        for key in keys:
+            value = self._recall(self._local_key(key, version))
+            if value is _MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing:
+            fetched = self._target.get_many(missing, version=version)
+            for key, value in fetched.items():
+                self._remember(self._local_key(key, version), value)
+            found.update(fetched)
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._target.set(key, value, timeout, version=version)
+        self._remember(self._local_key(key, version), value, timeout)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self._target.set_many(data, timeout, version=version)
+        for key, value in data.items():
+            if key not in failed:
+                self._remember(self._local_key(key, version), value, timeout)
+        return failed
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        # в ближний кеш не кладем: add служит для блокировок
+        self._forget([self._local_key(key, version)])
+        return self._target.add(key, value, timeout, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        self._forget([self._local_key(key, version)])
+        return self._target.incr(key, delta, version=version)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._target.touch(key, timeout, version=version)
+
+    def has_key(self, key, version=None):
+        self._check_generation()
+        if self._recall(self._local_key(key, version)) is not _MISSING:
+            return True
+        return self._target.has_key(key, version=version)
+
+    def delete(self, key, version=None):
+        self._forget([self._local_key(key, version)])
+        self._target.delete(key, version=version)
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        self._forget(self._local_key(key, version) for key in keys)
+        self._target.delete_many(keys, version=version)
+
+    def clear(self):
+        with self._store.lock:
+            self._store.data.clear()
+        self._target.clear()
+        self.bump_generation()
+
+    def close(self, **kwargs):
+        self._target.close(**kwargs)
+
+    def get_stats(self) -> dict:
+        '''Попадания и промахи ближнего кеша процесса.'''
+
+        with self._store.lock:
+            return {
+                'hits': self._store.hits,
+                'misses': self._store.misses,
+                'entries': len(self._store.data),
+            }
+
+
+class _Pickled(bytes):
+    pass
+
+
+_MISSING = object()
@@ -0,0 +1,466 @@
+'''
+Кеш в файле SQLite, общий для всех процессов сервера на машине.
+
+LocMemCache у каждого WSGI-воркера свой: промахи считаются
+в каждом воркере отдельно, а сброс версии в одном не виден другим.
+Этому бэкенду не нужен отдельный сервис: записи лежат в файле
+LOCATION в режиме WAL, читатели не ждут писателя, а запись
+из разных процессов сериализует сама SQLite.
+
+Размер кеша ограничен кол-вом записей (MAX_ENTRIES) и, если
+задан MAX_BYTES, суммой их размеров: страница в 200 КБ весит
+больше счетчика. Кол-во записей и сумму размеров ведут триггеры
+в таблице totals, так что запись не пересчитывает весь кеш.
+Вытесняются давно не читанные записи (LRU с точностью
+до ACCESS_RESOLUTION секунд). Значения крупнее COMPRESS_MIN_SIZE
+сжимаются zlib. Сколько места занимают ключи с данным
+префиксом, показывает get_usage() и команда cache_stats.
+
+Чтение ничего не пишет: время чтения записей и счетчики попаданий
+и промахов копятся в процессе и уходят в файл вместе с ближайшей
+записью или не чаще раза в FLUSH_INTERVAL секунд. Во втором случае
+чтение не ждет блокировку: если файл занят, отложенное подождет.
+См. get_stats().
+'''
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+# Файл со схемой другой версии пересоздается: это всего лишь кеш
+SCHEMA_VERSION = 3
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS cache (
+        key TEXT PRIMARY KEY,
+        value BLOB NOT NULL,
+        compressed INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        expires REAL,
+        accessed INTEGER NOT NULL
+    ) WITHOUT ROWID''',
+    'CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)',
+    '''CREATE TABLE IF NOT EXISTS totals (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        entries INTEGER NOT NULL,
+        bytes INTEGER NOT NULL
+    )''',
+    'INSERT OR IGNORE INTO totals (id, entries, bytes) VALUES (1, 0, 0)',
+    '''CREATE TRIGGER IF NOT EXISTS cache_inserted AFTER INSERT ON cache
+    BEGIN
+        UPDATE totals SET entries = entries + 1, bytes = bytes + NEW.size;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS cache_deleted AFTER DELETE ON cache
+    BEGIN
+        UPDATE totals SET entries = entries - 1, bytes = bytes - OLD.size;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS cache_resized
+    AFTER UPDATE OF size ON cache
+    BEGIN
+        UPDATE totals SET bytes = bytes + NEW.size - OLD.size;
+    END''',
+    '''CREATE TABLE IF NOT EXISTS stats (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )''',
+)
+
+# Время последнего чтения обновляется не чаще, сек.
+ACCESS_RESOLUTION = 1
+
+# Отложенное чтениями пишется в файл без других записей не чаще, сек.
+FLUSH_INTERVAL = 5
+
+
+class SQLiteCache(BaseCache):
+    '''
+    CACHES = {'default': {
+        'BACKEND': 'core.backends.sqlite.SQLiteCache',
+        'LOCATION': '/var/tmp/yatube-cache.sqlite3',
+    }}
+    OPTIONS: MAX_ENTRIES и CULL_FREQUENCY как у встроенных бэкендов,
+    MAX_BYTES - предел суммы размеров записей (None - без предела),
+    COMPRESS_MIN_SIZE - с какого размера значения сжимаются
+    (None - не сжимать), BUSY_TIMEOUT - сколько секунд ждать
+    чужую запись.
+    '''
+
+    def __init__(self, location: str, params: dict):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._location = location
+        self._busy_timeout = float(options.get('BUSY_TIMEOUT', 5))
+        self._max_bytes = options.get('MAX_BYTES')
+        self._compress_min_size = options.get('COMPRESS_MIN_SIZE')
+        self._local = threading.local()
+        self._pending_lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+        self._accessed = {}
+        self._flushed = time.monotonic()
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        '''Свое соединение у каждого потока; после fork - новое.'''
+
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            directory = os.path.dirname(self._location)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(
+                self._location,
+                timeout=self._busy_timeout,
+                isolation_level=None,
+            )
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            with _Transaction(connection) as cursor:
+                version = cursor.execute('PRAGMA user_version').fetchone()
+                if version[0] != SCHEMA_VERSION:
+                    cursor.execute('DROP TABLE IF EXISTS cache')
+                    cursor.execute('DROP TABLE IF EXISTS totals')
+                    cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+                for statement in SCHEMA:
+                    cursor.execute(statement)
+            local.connection = connection
+            local.pid = os.getpid()
+        return local.connection
+
+    def _write(self, wait: bool = True):
+        '''
+        Транзакция записи: BEGIN IMMEDIATE сразу берет блокировку.
+        Без wait занятый файл сразу дает sqlite3.OperationalError.
+        '''
+
+        return _Transaction(self._connection, None if wait else 0)
+
+    def _expiry(self, timeout) -> Optional[float]:
+        # уже абсолютное время: time.time() + timeout
+        return self.get_backend_timeout(timeout)
+
+    def _key(self, key, version) -> str:
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def _encode(self, value) -> Tuple[bytes, bool]:
+        '''pickle и, если значение крупное и сжимается, zlib.'''
+
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if (
+            self._compress_min_size is not None
+            and len(data) >= self._compress_min_size
+        ):
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                return compressed, True
+        return data, False
+
+    @staticmethod
+    def _decode(data: bytes, compressed: bool):
+        return pickle.loads(zlib.decompress(data) if compressed else data)
+
+    def _fetch(self, keys: Iterable[str]) -> Dict[str, Any]:
+        '''Живые записи keys; заодно отмечаем их чтение.'''
+
+        keys = list(keys)
+        now = time.time()
+        rows = self._connection.execute(
+            'SELECT key, value, compressed, expires, accessed FROM cache '
+            'WHERE key IN ({})'.format(', '.join('?' * len(keys))),
+            keys,
+        ).fetchall()
+        found, touched = {}, []
+        for key, value, compressed, expires, accessed in rows:
+            if expires is not None and expires <= now:
+                continue
+            found[key] = self._decode(value, compressed)
+            if now - accessed >= ACCESS_RESOLUTION:
+                touched.append(key)
+        with self._pending_lock:
+            self._stats['hits'] += len(found)
+            self._stats['misses'] += len(keys) - len(found)
+            self._accessed.update(dict.fromkeys(touched, int(now)))
+            due = time.monotonic() - self._flushed >= FLUSH_INTERVAL
+        if due:
+            self._flush(wait=False)
+        return found
+
+    def _store(self, cursor, key: str, value, timeout,
+               replace: bool = True) -> None:
+        data, compressed = self._encode(value)
+        # не INSERT OR REPLACE: его удаление старой записи
+        # не вызывает триггер, и totals разошлись бы с таблицей
+        cursor.execute(
+            'INSERT INTO cache '
+            '(key, value, compressed, size, expires, accessed) '
+            'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (key) DO {}'.format(
+                'UPDATE SET value = excluded.value, '
+                'compressed = excluded.compressed, size = excluded.size, '
+                'expires = excluded.expires, accessed = excluded.accessed'
+                if replace else 'NOTHING'
+            ),
+            (
+                key,
+                data,
+                compressed,
+                len(key) + len(data),
+                self._expiry(timeout),
+                int(time.time()),
+            ),
+        )
+
+    def _over_budget(self, cursor) -> Tuple[int, int]:
+        '''Сколько записей и байт сверх MAX_ENTRIES и MAX_BYTES.'''
+
+        count, size = cursor.execute(
+            'SELECT entries, bytes FROM totals'
+        ).fetchone()
+        extra_bytes = size - self._max_bytes if self._max_bytes else 0
+        return count - self._max_entries, extra_bytes
+
+    def _cull(self, cursor) -> None:
+        '''
+        Сверх бюджета: сначала убираем просроченные записи, потом
+        давно не читанные - 1/CULL_FREQUENCY записей или столько,
+        чтобы освободить 1/CULL_FREQUENCY от MAX_BYTES.
+        Заодно пишем отложенное чтениями: порядок вытеснения
+        должен учитывать последние чтения.
+        '''
+
+        self._write_pending(cursor)
+        extra_entries, extra_bytes = self._over_budget(cursor)
+        if extra_entries <= 0 and extra_bytes <= 0:
+            return
+        cursor.execute(
+            'DELETE FROM cache WHERE expires <= ?', (time.time(),)
+        )
+        extra_entries, extra_bytes = self._over_budget(cursor)
+        if extra_entries <= 0 and extra_bytes <= 0:
+            return
+        if self._cull_frequency == 0:
+            cursor.execute('DELETE FROM cache')
+            return
+        if extra_entries > 0:
+            cursor.execute(
+                'DELETE FROM cache WHERE key IN ('
+                'SELECT key FROM cache ORDER BY accessed LIMIT ?)',
+                (
+                    (self._max_entries + extra_entries)
+                    // self._cull_frequency,
+                ),
+            )
+            extra_bytes = self._over_budget(cursor)[1]
+        if extra_bytes > 0:
+            # самые старые записи, пока их сумма не покроет излишек
+            cursor.execute(
+                'DELETE FROM cache WHERE key IN ('
+                'SELECT key FROM ('
+                'SELECT key, size, SUM(size) OVER ('
+                'ORDER BY accessed, key) AS running FROM cache'
+                ') WHERE running - size < ?)',
+                (extra_bytes + self._max_bytes // self._cull_frequency,),
+            )
+
+    def get(self, key, default=None, version=None):
+        key = self._key(key, version)
+        return self._fetch([key]).get(key, default)
+
+    def get_many(self, keys, version=None):
+        keys = {self._key(key, version): key for key in keys}
+        if not keys:
+            return {}
+        return {
+            keys[key]: value for key, value in self._fetch(keys).items()
+        }
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        with self._write() as cursor:
+            self._store(cursor, key, value, timeout)
+            self._cull(cursor)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        items = [(self._key(key, version), value)
+                 for key, value in data.items()]
+        with self._write() as cursor:
+            for key, value in items:
+                self._store(cursor, key, value, timeout)
+            self._cull(cursor)
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        with self._write() as cursor:
+            cursor.execute(
+                'DELETE FROM cache WHERE key = ? AND expires <= ?',
+                (key, time.time()),
+            )
+            self._store(cursor, key, value, timeout, replace=False)
+            added = cursor.rowcount == 1
+            if added:
+                self._cull(cursor)
+        return added
+
+    def incr(self, key, delta=1, version=None):
+        key = self._key(key, version)
+        # чтение и запись в одной транзакции: между ними никто не влезет
+        with self._write() as cursor:
+            row = cursor.execute(
+                'SELECT value, compressed, expires FROM cache '
+                'WHERE key = ? AND (expires IS NULL OR expires > ?)',
+                (key, time.time()),
+            ).fetchone()
+            if row is None:
+                raise ValueError("Key '%s' not found" % key)
+            value = self._decode(row[0], row[1]) + delta
+            data, compressed = self._encode(value)
+            cursor.execute(
+                'UPDATE cache SET value = ?, compressed = ?, size = ? '
+                'WHERE key = ?',
+                (data, compressed, len(key) + len(data), key),
+            )
+        return value
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        with self._write() as cursor:
+            cursor.execute(
+                'UPDATE cache SET expires = ? WHERE key = ? '
+                'AND (expires IS NULL OR expires > ?)',
+                (self._expiry(timeout), key, time.time()),
+            )
+            return cursor.rowcount == 1
+
+    def has_key(self, key, version=None):
+        key = self._key(key, version)
+        return self._connection.execute(
+            'SELECT 1 FROM cache WHERE key = ? '
+            'AND (expires IS NULL OR expires > ?)',
+            (key, time.time()),
+        ).fetchone() is not None
+
+    def delete(self, key, version=None):
+        key = self._key(key, version)
+        with self._write() as cursor:
+            cursor.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def delete_many(self, keys, version=None):
+        keys = [(self._key(key, version),) for key in keys]
+        if keys:
+            with self._write() as cursor:
+                cursor.executemany('DELETE FROM cache WHERE key = ?', keys)
+
+    def clear(self):
+        with self._write() as cursor:
+            cursor.execute('DELETE FROM cache')
+
+    def close(self, **kwargs):
+        # соединения потоков живут до конца процесса, как и LocMemCache
+        pass
+
+    def _write_pending(self, cursor) -> None:
+        '''
+        Пишем в транзакции cursor отложенные чтениями время чтения
+        записей и счетчики. Если транзакция откатится, они пропадут:
+        это лишь порядок вытеснения и статистика.
+        '''
+
+        with self._pending_lock:
+            stats, accessed = self._stats, self._accessed
+            self._stats, self._accessed = {'hits': 0, 'misses': 0}, {}
+            self._flushed = time.monotonic()
+        if accessed:
+            # запись могли перезаписать позже чтения
+            cursor.executemany(
+                'UPDATE cache SET accessed = MAX(accessed, ?) '
+                'WHERE key = ?',
+                [(when, key) for key, when in accessed.items()],
+            )
+        if any(stats.values()):
+            cursor.executemany(
+                'INSERT INTO stats (name, value) VALUES (?, ?) '
+                'ON CONFLICT (name) DO UPDATE '
+                'SET value = value + excluded.value',
+                stats.items(),
+            )
+
+    def _flush(self, wait: bool) -> None:
+        try:
+            with self._write(wait) as cursor:
+                self._write_pending(cursor)
+        except sqlite3.OperationalError:
+            # файл занят: допишем с ближайшей записью или через
+            # FLUSH_INTERVAL, а не на каждом чтении
+            with self._pending_lock:
+                self._flushed = time.monotonic()
+
+    def get_stats(self) -> Dict[str, int]:
+        '''Попадания и промахи всех процессов, кол-во записей и байт.'''
+
+        self._flush(wait=True)
+        connection = self._connection
+        stats = dict(connection.execute('SELECT name, value FROM stats'))
+        entries, size = connection.execute(
+            'SELECT entries, bytes FROM totals'
+        ).fetchone()
+        return {
+            'hits': stats.get('hits', 0),
+            'misses': stats.get('misses', 0),
+            'entries': entries,
+            'bytes': size,
+        }
+
+    def get_usage(self, prefixes: Iterable[str]) -> Dict[str, tuple]:
+        '''
+        Кол-во записей и байт под каждым префиксом ключа:
+        {префикс: (записи, байты)}. Префикс - как ключ в cache.set,
+        KEY_PREFIX и текущая версия добавляются.
+        '''
+
+        usage = {}
+        for prefix in prefixes:
+            prefix_key = self.make_key(prefix)
+            usage[prefix] = self._connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache '
+                'WHERE substr(key, 1, ?) = ?',
+                (len(prefix_key), prefix_key),
+            ).fetchone()
+        return usage
+
+
+class _Transaction:
+    '''
+    BEGIN IMMEDIATE ... COMMIT. С busy_timeout чужую запись ждем
+    столько секунд, а не сколько задано у соединения.
+    '''
+
+    def __init__(self, connection: sqlite3.Connection,
+                 busy_timeout: Optional[float] = None):
+        self.connection = connection
+        self.busy_timeout = busy_timeout
+
+    def _set_busy_timeout(self, seconds: float) -> None:
+        self.connection.execute(f'PRAGMA busy_timeout = {int(seconds * 1000)}')
+
+    def __enter__(self) -> sqlite3.Cursor:
+        self.cursor = self.connection.cursor()
+        if self.busy_timeout is None:
+            self.cursor.execute('BEGIN IMMEDIATE')
+            return self.cursor
+        previous = self.connection.execute('PRAGMA busy_timeout').fetchone()
+        self._set_busy_timeout(self.busy_timeout)
+        try:
+            self.cursor.execute('BEGIN IMMEDIATE')
+        finally:
+            self._set_busy_timeout(previous[0] / 1000)
+        return self.cursor
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.cursor.execute('ROLLBACK' if exc_type else 'COMMIT')
+        self.cursor.close()
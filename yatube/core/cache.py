@@ -0,0 +1,312 @@
+import gzip
+import re
+import time
+from copy import deepcopy
+from functools import wraps
+from hashlib import md5
+from typing import Callable, Iterable, List, Optional, Union
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import (get_cache_key, has_vary_header,
+                                learn_cache_key, patch_cache_control,
+                                patch_vary_headers)
+from django.utils.text import compress_string
+
+from .holes import Shell
+
+VersionKeys = Union[Iterable[str], Callable[..., Iterable[str]]]
+
+# Как часто ожидающий запрос проверяет кеш, сек.
+PAGE_CACHE_POLL_INTERVAL = 0.05
+
+# Как в GZipMiddleware: короче не сжимаем
+GZIP_MIN_LENGTH = 200
+ACCEPTS_GZIP_RE = re.compile(r'\bgzip\b')
+
+
+def _new_version() -> str:
+    return uuid4().hex[:12]
+
+
+def get_versions(keys: Iterable[str]) -> List[str]:
+    '''Получаем текущие версии ключей, недостающие создаем.'''
+
+    keys = list(keys)
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        # add, а не set: версию, созданную параллельным
+        # запросом, не перетираем
+        for key in missing:
+            cache.add(key, _new_version(), None)
+        versions.update(cache.get_many(missing))
+    return [versions[key] for key in keys]
+
+
+def bump_versions(keys: Iterable[str]) -> None:
+    '''Меняем версии ключей: все закешированное под ними устаревает.'''
+
+    keys = list(keys)
+    if keys:
+        cache.set_many({key: _new_version() for key in keys}, None)
+        # старые версии могли остаться в ближних кешах других
+        # процессов, см. core.backends.near
+        bump_generation = getattr(cache, 'bump_generation', None)
+        if bump_generation:
+            bump_generation()
+
+
+def cache_page_versioned(
+    timeout: int,
+    key_prefix: str,
+    version_keys: VersionKeys,
+    shell: bool = False,
+    private: bool = False,
+) -> Callable:
+    '''
+    Аналог cache_page, в префикс ключа которого входят версии
+    version_keys. Смена любой версии (bump_versions) сбрасывает
+    все варианты страницы, включая номера страниц.
+    version_keys - список ключей или функция от аргументов view.
+    С shell в кеш кладется каркас страницы, общий для всех
+    пользователей, а личные части ({% hole %}) заполняются
+    для каждого запроса, см. core.holes.
+
+    timeout - срок только для серверного кеша: его сбрасывают
+    версии, а браузер о них не знает. Клиенту уходит
+    max-age=PAGE_CACHE_CLIENT_MAX_AGE, а страницам, личным для
+    пользователя (private или shell), еще и private, чтобы их
+    не хранили общие прокси.
+
+    Одновременные промахи по одной странице не рендерят ее
+    параллельно: страницу считает один запрос, остальные ждут
+    его результата или получают устаревшую копию.
+    В кеше страница лежит сжатой gzip и отдается как есть
+    клиентам с Accept-Encoding: gzip.
+    '''
+
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view_func(request, *args, **kwargs)
+            keys = version_keys
+            if callable(keys):
+                keys = keys(request, *args, **kwargs)
+            prefix = '.'.join([key_prefix] + get_versions(keys))
+
+            def render() -> tuple:
+                '''Ответ view и дыры его каркаса (None без shell).'''
+
+                if not shell:
+                    return view_func(request, *args, **kwargs), None
+                # тег {% hole %} оставит метки и запишет сюда дыры;
+                # убираем список и при исключении: страницу 404
+                # рендерит обработчик, и метки ей не нужны
+                request.page_holes = []
+                try:
+                    response = view_func(request, *args, **kwargs)
+                    if callable(getattr(response, 'render', None)):
+                        response.render()
+                    return response, request.page_holes
+                finally:
+                    del request.page_holes
+
+            return _cached_response(
+                request, prefix, timeout, render, private or shell
+            )
+        return wrapper
+
+    return decorator
+
+
+def _get_entry(request, prefix: str) -> Optional[tuple]:
+    '''
+    Запись страницы: (время устаревания, ответ, каркас или None)
+    или None.
+    '''
+
+    key = get_cache_key(request, prefix, request.method, cache=cache)
+    return cache.get(key) if key else None
+
+
+def _cached_response(
+    request, prefix, timeout, render, private
+) -> HttpResponse:
+    '''
+    Ответ из кеша или от render(). Запись живет в кеше дольше
+    своего timeout на PAGE_CACHE_STALE_TIMEOUT: пока один запрос
+    пересчитывает устаревшую страницу, остальные получают старую.
+    Если старой копии нет (страницу сбросили сменой версии),
+    они ждут до PAGE_CACHE_LOCK_WAIT секунд, а потом
+    рендерят страницу сами.
+    '''
+
+    entry = _get_entry(request, prefix)
+    if entry and entry[0] > time.time():
+        return _response_for(request, entry)
+
+    lock_key = '{}.lock.{}'.format(
+        prefix, md5(request.build_absolute_uri().encode()).hexdigest()
+    )
+    deadline = time.monotonic() + settings.PAGE_CACHE_LOCK_WAIT
+    while not cache.add(lock_key, 1, settings.PAGE_CACHE_LOCK_TIMEOUT):
+        if entry:
+            return _response_for(request, entry)
+        if time.monotonic() >= deadline:
+            return _store_response(
+                request, prefix, timeout, private, *render()
+            )
+        time.sleep(PAGE_CACHE_POLL_INTERVAL)
+        entry = _get_entry(request, prefix)
+        if entry and entry[0] > time.time():
+            return _response_for(request, entry)
+
+    try:
+        # страницу могли сохранить, пока мы брали блокировку
+        entry = _get_entry(request, prefix)
+        if entry and entry[0] > time.time():
+            return _response_for(request, entry)
+        return _store_response(
+            request, prefix, timeout, private, *render()
+        )
+    finally:
+        cache.delete(lock_key)
+
+
+def _store_response(
+    request, prefix, timeout, private, response, holes
+) -> HttpResponse:
+    '''
+    Кладем ответ в кеш по тем же правилам, что и cache_page.
+    С holes в кеш идет каркас, а ответ получает заполненные дыры.
+    '''
+
+    if (
+        response.streaming
+        or response.status_code != 200
+        or 'private' in response.get('Cache-Control', ())
+        # не раздаем чужие куки, выданные запросу без кук
+        or not request.COOKIES and response.cookies
+        and has_vary_header(response, 'Cookie')
+    ):
+        if holes:
+            # в кеш не идет, но метки нужно заполнить
+            response.content = Shell(
+                response.content, holes, response.charset
+            ).render(request)
+        return response
+
+    patch_cache_control(
+        response, max_age=settings.PAGE_CACHE_CLIENT_MAX_AGE
+    )
+    if private:
+        patch_cache_control(response, private=True)
+    lifetime = timeout + settings.PAGE_CACHE_STALE_TIMEOUT
+    key = learn_cache_key(request, response, lifetime, prefix, cache=cache)
+    fresh_until = time.time() + timeout
+    if holes is None:
+        entry = (fresh_until, _gzip_response(response), None)
+    else:
+        entry = (
+            fresh_until,
+            _copy_response(response, b''),
+            Shell(response.content, holes, response.charset),
+        )
+    cache.set(key, entry, lifetime)
+
+    if holes is None and entry[1] is not response and not _accepts_gzip(
+        request
+    ):
+        # этот ответ уже есть, распаковывать сжатую копию незачем
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+    return _response_for(request, entry)
+
+
+class _EncodedResponse(HttpResponse):
+    '''
+    Ответ в кодировке gzip. Его ETag, в том числе тот, что потом
+    поставит condition(), слабый, как у GZipMiddleware: сжатое тело
+    побайтно не совпадает с несжатым под тем же ETag, и ни кеши,
+    ни If-Range не должны считать их одинаковыми.
+    '''
+
+    def __setitem__(self, header, value):
+        if header.lower() == 'etag' and not value.startswith('W/'):
+            value = 'W/' + value
+        super().__setitem__(header, value)
+
+
+def _copy_response(
+    response, content, response_class=HttpResponse
+) -> HttpResponse:
+    duplicate = response_class(
+        content, status=response.status_code, reason=response.reason_phrase
+    )
+    for header, value in response.items():
+        duplicate[header] = value
+    duplicate.cookies = deepcopy(response.cookies)
+    duplicate['Content-Length'] = len(content)
+    return duplicate
+
+
+def _gzip_response(response) -> HttpResponse:
+    '''
+    Сжатая копия ответа для кеша: сжимаем один раз при заполнении,
+    а не при каждом попадании. Если сжатие не помогает - сам ответ.
+    '''
+
+    if len(response.content) < GZIP_MIN_LENGTH or response.has_header(
+        'Content-Encoding'
+    ):
+        return response
+    content = compress_string(response.content)
+    if len(content) >= len(response.content):
+        return response
+    compressed = _copy_response(response, content)
+    compressed['Content-Encoding'] = 'gzip'
+    return compressed
+
+
+def _accepts_gzip(request) -> bool:
+    return bool(ACCEPTS_GZIP_RE.search(
+        request.META.get('HTTP_ACCEPT_ENCODING', '')
+    ))
+
+
+def _response_for(request, entry: tuple) -> HttpResponse:
+    '''
+    Ответ по записи кеша: с заполненными для этого запроса дырами
+    каркаса и в кодировке, которую принимает клиент.
+    '''
+
+    _, response, shell = entry
+    if shell is not None:
+        if _accepts_gzip(request):
+            response = _copy_response(
+                response, shell.render_gzip(request), _EncodedResponse
+            )
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = _copy_response(response, shell.render(request))
+        # Accept-Encoding в Vary уже после learn_cache_key: каркас
+        # один на всех, в ключ ни кодировка, ни куки не входят
+        patch_vary_headers(response, ('Cookie', 'Accept-Encoding'))
+        return response
+
+    if response.get('Content-Encoding') == 'gzip':
+        if _accepts_gzip(request):
+            response = _copy_response(
+                response, response.content, _EncodedResponse
+            )
+        else:
+            response = _copy_response(
+                response, gzip.decompress(response.content)
+            )
+            del response['Content-Encoding']
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
@@ -0,0 +1,105 @@
+'''
+Каркас страницы, общий для всех пользователей, с дырами.
+
+Шапка, кнопка подписки, форма комментария с CSRF-токеном зависят
+от пользователя, и из-за них страница целиком становилась личной.
+Такие места в шаблонах оборачиваются тегом {% hole 'имя' ... %}
+(core.templatetags.holes). Когда страница рендерится для кеша,
+тег вместо содержимого оставляет метку, а имя дыры и ее аргументы
+запоминаются. В кеше лежит каркас (Shell), а дыры заполняются
+для каждого запроса уже после поиска в кеше.
+
+Куски каркаса между дырами заранее сжаты deflate с выравниванием
+по байту (Z_SYNC_FLUSH): gzip-ответ собирается из них и сжатых
+на лету маленьких дыр, без сжатия всей страницы.
+'''
+import re
+import struct
+import zlib
+from typing import Callable, Dict, List, Tuple
+
+from django.template.loader import render_to_string
+
+HOLE_MARKER = '<!--hole:{}-->'
+HOLE_RE = re.compile(rb'<!--hole:(\d+)-->')
+
+# Заголовок gzip: deflate, без имени файла и времени, ОС неизвестна
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+# Пустой последний блок deflate
+FINAL_BLOCK = zlib.compressobj(wbits=-zlib.MAX_WBITS).flush()
+
+_holes: Dict[str, Tuple[str, Callable]] = {}
+
+
+def register(name: str, template_name: str) -> Callable:
+    '''
+    Регистрируем дыру name: шаблон и функция его контекста
+    (request, **аргументы тега) -> dict.
+    '''
+
+    def decorator(get_context):
+        _holes[name] = (template_name, get_context)
+        return get_context
+
+    return decorator
+
+
+def render_hole(request, name: str, kwargs: dict) -> str:
+    template_name, get_context = _holes[name]
+    return render_to_string(
+        template_name, get_context(request, **kwargs), request=request
+    )
+
+
+def _deflate(data: bytes) -> bytes:
+    '''Сжатый кусок, после которого можно дописать следующий.'''
+
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class Shell:
+    '''Каркас страницы: куски между дырами и сами дыры.'''
+
+    def __init__(self, content: bytes, holes: List[tuple], charset: str):
+        parts = HOLE_RE.split(content)
+        self.segments = parts[0::2]
+        self.order = [int(index) for index in parts[1::2]]
+        self.deflated = [_deflate(segment) for segment in self.segments]
+        self.holes = holes
+        self.charset = charset
+
+    def _fill(self, request) -> List[bytes]:
+        return [
+            render_hole(request, *self.holes[index]).encode(self.charset)
+            for index in self.order
+        ]
+
+    def render(self, request) -> bytes:
+        fills = self._fill(request) + [b'']
+        return b''.join(
+            segment + fill for segment, fill in zip(self.segments, fills)
+        )
+
+    def render_gzip(self, request) -> bytes:
+        fills = self._fill(request) + [b'']
+        chunks = [GZIP_HEADER]
+        crc = size = 0
+        for segment, deflated, fill in zip(
+            self.segments, self.deflated, fills
+        ):
+            chunks.append(deflated)
+            if fill:
+                chunks.append(_deflate(fill))
+            # контрольная сумма - по несжатой странице целиком
+            crc = zlib.crc32(fill, zlib.crc32(segment, crc))
+            size += len(segment) + len(fill)
+        chunks.append(FINAL_BLOCK)
+        chunks.append(struct.pack('<II', crc, size & 0xffffffff))
+        return b''.join(chunks)
+
+
+@register('header', 'includes/header.html')
+def header_context(request):
+    return {}
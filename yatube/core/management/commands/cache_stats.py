@@ -0,0 +1,47 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+
+# Префиксы ключей страниц, карточек и хранилища ключей sorl
+DEFAULT_PREFIXES = (
+    'views.decorators.cache.cache_page.index_page.',
+    'views.decorators.cache.cache_page.follow_page.',
+    'views.decorators.cache.cache_page.group_page.',
+    'views.decorators.cache.cache_page.profile_page.',
+    'views.decorators.cache.cache_page.post_page.',
+    'views.decorators.cache.cache_header.',
+    'post_info.',
+    'sorl-thumbnail',
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Показывает попадания, промахи и занятое место в кешах, '
+        'а для кешей с бюджетом - сколько занимает каждый префикс ключей.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'prefixes',
+            nargs='*',
+            help='Префиксы ключей; по умолчанию страницы, карточки и sorl',
+        )
+
+    def handle(self, *args, **options):
+        prefixes = options['prefixes'] or DEFAULT_PREFIXES
+        for alias in settings.CACHES:
+            cache = caches[alias]
+            if hasattr(cache, 'get_stats'):
+                stats = ', '.join(
+                    f'{name}: {value}'
+                    for name, value in cache.get_stats().items()
+                )
+                self.stdout.write(f'{alias}: {stats}')
+            if hasattr(cache, 'get_usage'):
+                for prefix, (entries, size) in cache.get_usage(
+                    prefixes
+                ).items():
+                    self.stdout.write(
+                        f'  {prefix}: записей {entries}, байт {size}'
+                    )
@@ -0,0 +1,26 @@
+from django.db import models
+
+
+class StoredFile(models.Model):
+    '''
+    Файл хранилища с адресацией по содержимому.
+    Атрибуты:
+    ----------
+    name : str
+        имя файла в хранилище
+    refs : int
+        кол-во ссылок на файл; при нуле файл удаляется
+    '''
+
+    name = models.CharField(
+        verbose_name="Имя файла",
+        max_length=255,
+        primary_key=True,
+    )
+    refs = models.PositiveIntegerField(
+        verbose_name="Кол-во ссылок",
+        default=0,
+    )
+
+    def __str__(self):
+        return f'{self.name} ({self.refs})'
@@ -0,0 +1,156 @@
+'''
+Хранилище файлов с адресацией по содержимому.
+
+Имя файла - SHA-256 его содержимого, файлы раскладываются по
+вложенным каталогам по первым символам хеша:
+posts/ab/cd/abcd...ef.jpg. Одинаковые загрузки хранятся один раз,
+кол-во ссылок на файл ведется в core.StoredFile: save() добавляет
+ссылку, delete() убирает, файл удаляется вместе с последней.
+Файлы, которых нет в StoredFile (загруженные до появления
+хранилища), delete() не трогает.
+'''
+import hashlib
+import os
+import re
+import tempfile
+from typing import Iterator
+
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import F
+from django.utils.deconstruct import deconstructible
+
+from .models import StoredFile
+
+HASH_NAME_RE = re.compile(
+    r'(^|/)(?P<a>[0-9a-f]{2})/(?P<b>[0-9a-f]{2})/'
+    r'(?P=a)(?P=b)[0-9a-f]{60}(\.\w+)?$'
+)
+
+
+def content_hash(content) -> str:
+    '''SHA-256 содержимого файла, читаем кусками.'''
+
+    digest = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return digest.hexdigest()
+
+
+def is_hashed_name(name: str) -> bool:
+    return bool(HASH_NAME_RE.search(name))
+
+
+def walk_storage(storage, path: str) -> Iterator[str]:
+    '''
+    Имена всех файлов каталога хранилища в порядке сравнения строк;
+    в памяти держим только содержимое одного каталога на уровень.
+    '''
+
+    if not storage.exists(path):
+        return
+    directories, files = storage.listdir(path)
+    # каталог сортируем как 'имя/', чтобы порядок совпадал
+    # со сравнением полных имен
+    entries = sorted(
+        [(name, name) for name in files]
+        + [(name + '/', name) for name in directories]
+    )
+    for key, name in entries:
+        full_name = os.path.join(path, name)
+        if key.endswith('/'):
+            yield from walk_storage(storage, full_name)
+        else:
+            yield full_name
+
+
+@deconstructible
+class HashedFileSystemStorage(FileSystemStorage):
+
+    def hashed_name(self, name: str, digest: str) -> str:
+        '''Имя по хешу в каталоге и с расширением исходного имени.'''
+
+        directory = os.path.dirname(name)
+        extension = os.path.splitext(name)[1].lower()
+        return os.path.join(
+            directory, digest[:2], digest[2:4], digest + extension
+        )
+
+    def get_available_name(self, name, max_length=None):
+        # имя все равно заменит хеш содержимого
+        return name
+
+    def _save(self, name, content):
+        name = self.hashed_name(name, content_hash(content))
+        self.touch(name)
+        self.add_reference(name)
+        if not self.exists(name):
+            self._write(name, content)
+        return name
+
+    def _write(self, name: str, content) -> None:
+        '''
+        Пишем во временный файл рядом и переименовываем: параллельная
+        загрузка того же содержимого просто перезапишет его тем же.
+        '''
+
+        path = self.path(name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        if self.directory_permissions_mode is not None:
+            os.chmod(directory, self.directory_permissions_mode)
+        descriptor, temporary = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(descriptor, 'wb') as output:
+                for chunk in content.chunks():
+                    output.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(temporary, self.file_permissions_mode)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+    def touch(self, name: str) -> bool:
+        '''
+        Обновляем время изменения уже лежащего файла: сборщик мусора
+        не трогает свежие файлы, и повторная загрузка не потеряет
+        файл, пока пост с ней еще не сохранен.
+        '''
+
+        try:
+            os.utime(self.path(name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def add_reference(self, name: str, count: int = 1) -> None:
+        # get_or_create переживает гонку двух первых ссылок
+        StoredFile.objects.get_or_create(name=name)
+        StoredFile.objects.filter(name=name).update(
+            refs=F('refs') + count
+        )
+
+    def delete(self, name):
+        '''Убираем ссылку на файл; последняя ссылка удаляет файл.'''
+
+        with transaction.atomic():
+            stored = StoredFile.objects.select_for_update().filter(
+                name=name
+            ).first()
+            if stored is None:
+                return
+            if stored.refs > 1:
+                StoredFile.objects.filter(name=name).update(
+                    refs=F('refs') - 1
+                )
+                return
+            stored.delete()
+        super().delete(name)
+
+
+post_image_storage = HashedFileSystemStorage()
@@ -0,0 +1,22 @@
+from django import template
+from django.utils.safestring import mark_safe
+
+from ..holes import HOLE_MARKER, render_hole
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def hole(context, name, **kwargs):
+    '''
+    Личная часть страницы. При рендеринге каркаса для кеша
+    (request.page_holes - список) вместо нее остается метка,
+    иначе она рендерится сразу.
+    '''
+
+    request = context.get('request')
+    holes = getattr(request, 'page_holes', None)
+    if holes is None:
+        return render_hole(request, name, kwargs)
+    holes.append((name, kwargs))
+    return mark_safe(HOLE_MARKER.format(len(holes) - 1))
@@ -0,0 +1,41 @@
+'''
+Запуск тестов: файлы кешей SQLite (core.backends.sqlite) лежат
+во временном каталоге, а не там, где их держит сервер разработчика.
+Тесты чистят кеш, и живой кеш пропадал бы вместе с тестовым.
+'''
+import os
+import shutil
+import tempfile
+from copy import deepcopy
+
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+SQLITE_CACHE_BACKEND = 'core.backends.sqlite.SQLiteCache'
+
+
+def temporary_caches(directory: str) -> dict:
+    '''CACHES проекта с файлами кешей SQLite в directory.'''
+
+    caches = deepcopy(settings.CACHES)
+    for alias, params in caches.items():
+        if params['BACKEND'] == SQLITE_CACHE_BACKEND:
+            params['LOCATION'] = os.path.join(directory, f'{alias}.sqlite3')
+    return caches
+
+
+class TestRunner(DiscoverRunner):
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.cache_directory = tempfile.mkdtemp()
+        self.cache_settings = override_settings(
+            CACHES=temporary_caches(self.cache_directory)
+        )
+        self.cache_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.cache_settings.disable()
+        shutil.rmtree(self.cache_directory, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
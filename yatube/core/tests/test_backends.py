@@ -0,0 +1,263 @@
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import SimpleTestCase, override_settings
+
+from ..backends.near import GENERATION_KEY
+from ..backends.sqlite import SQLiteCache
+from ..cache import bump_versions
+
+
+def increment(location, times):
+    cache = SQLiteCache(location, {})
+    for _ in range(times):
+        cache.incr('counter')
+
+
+class SQLiteCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.location = os.path.join(self.directory, 'cache.sqlite3')
+        self.cache = SQLiteCache(self.location, {
+            'OPTIONS': {'MAX_ENTRIES': 4, 'CULL_FREQUENCY': 2},
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_basic_operations(self):
+        '''get/set/add/delete и пачки get_many/set_many.'''
+        self.cache.set('a', {'value': 1})
+        self.assertEqual(self.cache.get('a'), {'value': 1})
+        self.assertFalse(self.cache.add('a', 2))
+        self.assertTrue(self.cache.add('b', 2))
+        self.cache.set_many({'c': 3, 'd': 4})
+        self.assertEqual(
+            self.cache.get_many(['a', 'b', 'c', 'missing']),
+            {'a': {'value': 1}, 'b': 2, 'c': 3}
+        )
+        self.cache.delete_many(['a', 'b'])
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b', 'default'), 'default')
+
+    def test_entries_are_shared(self):
+        '''Другое соединение с файлом видит те же записи.'''
+        self.cache.set('shared', 'value')
+        other = SQLiteCache(self.location, {})
+        self.assertEqual(other.get('shared'), 'value')
+        other.delete('shared')
+        self.assertFalse(self.cache.has_key('shared'))
+
+    def test_timeout(self):
+        '''Просроченная запись не отдается, а add ее заменяет.'''
+        self.cache.set('ttl', 'old', timeout=10)
+        later = time.time() + 20
+        with mock.patch('time.time', return_value=later):
+            self.assertIsNone(self.cache.get('ttl'))
+            self.assertTrue(self.cache.add('ttl', 'new', timeout=10))
+            self.assertEqual(self.cache.get('ttl'), 'new')
+
+    def test_least_recently_used_are_culled(self):
+        '''Сверх MAX_ENTRIES вытесняются давно не читанные записи.'''
+        now = time.time()
+        for number in range(4):
+            with mock.patch('time.time', return_value=now + number * 10):
+                self.cache.set(number, number)
+        with mock.patch('time.time', return_value=now + 50):
+            # читаем самую старую запись: она теперь свежая
+            self.assertEqual(self.cache.get(0), 0)
+        with mock.patch('time.time', return_value=now + 60):
+            self.cache.set(4, 4)
+        self.assertEqual(
+            sorted(self.cache.get_many(range(5))), [0, 3, 4]
+        )
+
+    def test_incr_is_atomic_across_processes(self):
+        '''incr из нескольких процессов не теряет приращений.'''
+        self.cache.set('counter', 0)
+        context = multiprocessing.get_context('fork')
+        processes = [
+            context.Process(target=increment, args=(self.location, 50))
+            for _ in range(4)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual(self.cache.get('counter'), 200)
+        with self.assertRaises(ValueError):
+            self.cache.incr('missing')
+
+    def test_byte_budget(self):
+        '''Сверх MAX_BYTES вытесняются давно не читанные записи.'''
+        cache = SQLiteCache(self.location, {
+            'OPTIONS': {'MAX_BYTES': 3000, 'CULL_FREQUENCY': 3},
+        })
+        now = time.time()
+        for number in range(3):
+            with mock.patch('time.time', return_value=now + number * 10):
+                cache.set(f'page{number}', os.urandom(900))
+        with mock.patch('time.time', return_value=now + 30):
+            cache.get('page0')
+            # мелкий счетчик не вытесняет крупные страницы
+            cache.set('counter', 1)
+        self.assertEqual(cache.get_stats()['entries'], 4)
+        with mock.patch('time.time', return_value=now + 40):
+            cache.set('page3', os.urandom(900))
+        self.assertEqual(
+            sorted(cache.get_many(
+                ['page0', 'page1', 'page2', 'page3', 'counter']
+            )),
+            ['counter', 'page0', 'page3']
+        )
+
+    def test_compression(self):
+        '''Крупные значения хранятся сжатыми и читаются как были.'''
+        cache = SQLiteCache(self.location, {
+            'OPTIONS': {'COMPRESS_MIN_SIZE': 100},
+        })
+        page = '<p>Пост</p>' * 1000
+        cache.set('views.page', page)
+        cache.set('views.small', 'x')
+        self.assertEqual(cache.get('views.page'), page)
+        usage = cache.get_usage(['views.', 'views.page', 'other'])
+        self.assertEqual(usage['views.'][0], 2)
+        self.assertLess(usage['views.page'][1], len(page) // 10)
+        self.assertEqual(usage['other'], (0, 0))
+
+    def test_running_totals(self):
+        '''Кол-во записей и байт ведется без пересчета всего кеша.'''
+        self.cache.set('a', 'x' * 100)
+        self.cache.set('a', 'x' * 10)
+        self.cache.add('a', 'x' * 1000)
+        self.cache.set_many({'b': 1, 'c': 2})
+        self.cache.incr('b', 10 ** 30)
+        self.cache.delete('c')
+        stats = self.cache.get_stats()
+        connection = sqlite3.connect(self.location)
+        self.assertEqual(
+            (stats['entries'], stats['bytes']),
+            connection.execute(
+                'SELECT COUNT(*), SUM(size) FROM cache'
+            ).fetchone()
+        )
+        connection.close()
+
+    def test_reads_do_not_wait_for_writers(self):
+        '''Чтение не ждет чужую запись, отложенное пишется позже.'''
+        self.cache.set('a', 1)
+        writer = sqlite3.connect(self.location, isolation_level=None)
+        writer.execute('BEGIN IMMEDIATE')
+        later = time.monotonic() + 60
+        try:
+            with mock.patch('time.monotonic', return_value=later):
+                started = time.perf_counter()
+                self.assertEqual(self.cache.get('a'), 1)
+            self.assertLess(time.perf_counter() - started, 1)
+        finally:
+            writer.execute('ROLLBACK')
+            writer.close()
+        self.assertEqual(self.cache.get_stats()['hits'], 1)
+
+    def test_stats(self):
+        '''Попадания и промахи считаются для всех соединений.'''
+        self.cache.set('a', 1)
+        self.cache.get_many(['a', 'b'])
+        other = SQLiteCache(self.location, {})
+        other.get('a')
+        other.get_stats()
+        stats = self.cache.get_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['entries'], 1)
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'near': {
+        'BACKEND': 'core.backends.near.NearCache',
+        'LOCATION': 'near_shared',
+        'OPTIONS': {'MAX_ENTRIES': 2, 'STAMP_INTERVAL': 1},
+    },
+    'near_shared': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'near-tests',
+    },
+})
+class NearCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.near = caches['near']
+        self.shared = caches['near_shared']
+        self.near.clear()
+
+    def test_reads_are_served_locally(self):
+        '''Прочитанное раз берется из памяти процесса.'''
+        self.shared.set('a', 'value')
+        self.assertEqual(self.near.get('a'), 'value')
+        with mock.patch.object(self.shared, 'get') as shared_get:
+            self.assertEqual(self.near.get('a'), 'value')
+            self.assertEqual(self.near.get_many(['a']), {'a': 'value'})
+        shared_get.assert_not_called()
+
+    def test_own_writes_are_visible_at_once(self):
+        '''Свои изменения процесс видит сразу.'''
+        self.near.set('a', 'old')
+        self.near.set('a', 'new')
+        self.assertEqual(self.near.get('a'), 'new')
+        self.near.delete('a')
+        self.assertIsNone(self.near.get('a'))
+
+    def test_other_workers_changes_after_stamp_interval(self):
+        '''Изменения другого воркера видны через STAMP_INTERVAL.'''
+        self.near.set('a', 'old')
+        self.assertEqual(self.near.get('a'), 'old')
+        # другой воркер меняет запись и поколение
+        self.shared.set('a', 'new')
+        self.shared.incr(GENERATION_KEY)
+        self.assertEqual(self.near.get('a'), 'old')
+
+        later = time.monotonic() + 2
+        with mock.patch('time.monotonic', return_value=later):
+            self.assertEqual(self.near.get('a'), 'new')
+
+    def test_only_invalidations_change_generation(self):
+        '''Обычные записи не сбрасывают ближние кеши других процессов.'''
+        self.near.bump_generation()
+        generation = self.shared.get(GENERATION_KEY)
+        self.near.set('a', 1)
+        self.near.set_many({'b': 2})
+        self.near.add('lock', 1)
+        self.near.delete('lock')
+        self.assertEqual(self.shared.get(GENERATION_KEY), generation)
+
+        with self.settings(CACHES={
+            **settings.CACHES, 'default': settings.CACHES['near']
+        }):
+            bump_versions(['a.version'])
+        self.assertEqual(self.shared.get(GENERATION_KEY), generation + 1)
+
+    def test_mutable_values_are_copied(self):
+        '''Изменяемое значение не делится между запросами.'''
+        self.near.set('a', {'items': [1]})
+        self.near.get('a')['items'].append(2)
+        self.assertEqual(self.near.get('a'), {'items': [1]})
+
+    def test_least_recently_used_are_evicted(self):
+        '''Сверх MAX_ENTRIES из памяти уходят давно не читанные.'''
+        for key in ('a', 'b', 'c'):
+            self.near.set(key, key)
+        with mock.patch.object(self.shared, 'get_many') as shared_get_many:
+            shared_get_many.return_value = {}
+            self.near.get_many(['a', 'b', 'c'])
+        shared_get_many.assert_called_once_with(['a'], version=None)
@@ -0,0 +1,166 @@
+import gzip
+import threading
+import time
+from unittest import mock
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.views.decorators.http import condition
+
+from ..cache import bump_versions, cache_page_versioned
+from ..holes import Shell
+
+VERSION_KEY = 'test_page.version'
+
+
+class CountingView:
+    '''View, которая считает вызовы и может притормозить.'''
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, request):
+        with self.lock:
+            self.calls += 1
+            calls = self.calls
+        time.sleep(self.delay)
+        return HttpResponse(f'render {calls} ' + 'Пост ' * 100)
+
+
+@override_settings(PAGE_CACHE_LOCK_WAIT=5)
+class CachePageVersionedTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def cached(self, view, timeout=60):
+        return cache_page_versioned(
+            timeout, key_prefix='test_page', version_keys=[VERSION_KEY]
+        )(view)
+
+    def test_concurrent_misses_render_once(self):
+        '''Одновременные промахи рендерят страницу один раз.'''
+        view = CountingView(delay=0.3)
+        cached_view = self.cached(view)
+        responses = []
+
+        def get():
+            responses.append(cached_view(self.factory.get('/page/')))
+
+        threads = [threading.Thread(target=get) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(view.calls, 1)
+        self.assertEqual(
+            {response.content[:8] for response in responses}, {b'render 1'}
+        )
+
+    def test_stale_copy_while_revalidating(self):
+        '''Пока страницу пересчитывают, отдается устаревшая копия.'''
+        view = CountingView()
+        cached_view = self.cached(view, timeout=10)
+        cached_view(self.factory.get('/page/'))
+
+        later = time.time() + 20
+        with mock.patch('core.cache.time.time', return_value=later):
+            # другой запрос уже пересчитывает страницу
+            with mock.patch.object(cache, 'add', return_value=False):
+                response = cached_view(self.factory.get('/page/'))
+            self.assertTrue(response.content.startswith(b'render 1'))
+            self.assertEqual(view.calls, 1)
+
+            # а без него устаревшую страницу считает сам запрос
+            response = cached_view(self.factory.get('/page/'))
+            self.assertTrue(response.content.startswith(b'render 2'))
+
+    def test_invalidated_page_is_not_served_stale(self):
+        '''После смены версии старая копия не отдается.'''
+        view = CountingView()
+        cached_view = self.cached(view)
+        cached_view(self.factory.get('/page/'))
+        bump_versions([VERSION_KEY])
+
+        response = cached_view(self.factory.get('/page/'))
+        self.assertTrue(response.content.startswith(b'render 2'))
+
+    @override_settings(PAGE_CACHE_CLIENT_MAX_AGE=30)
+    def test_client_cache_headers(self):
+        '''Клиенту уходит его max-age, а не срок серверного кеша.'''
+        shared = self.cached(CountingView(), timeout=3600)
+        private = cache_page_versioned(
+            3600, key_prefix='test_private', version_keys=[VERSION_KEY],
+            private=True,
+        )(CountingView())
+        for view, is_private in ((shared, False), (private, True)):
+            for _ in range(2):
+                response = view(self.factory.get('/page/'))
+                self.assertEqual(response.status_code, 200)
+                cache_control = response['Cache-Control']
+                self.assertIn('max-age=30', cache_control)
+                self.assertEqual('private' in cache_control, is_private)
+        self.assertEqual(private.__wrapped__.calls, 1)
+
+    def test_gzip_variant(self):
+        '''Сжатая копия готовится один раз и отдается по Accept-Encoding.'''
+        view = CountingView()
+        cached_view = self.cached(view)
+        plain = cached_view(self.factory.get('/page/')).content
+
+        for _ in range(2):
+            response = cached_view(self.factory.get(
+                '/page/', HTTP_ACCEPT_ENCODING='gzip, deflate'
+            ))
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', response['Vary'])
+            self.assertLess(len(response.content), len(plain))
+            self.assertEqual(gzip.decompress(response.content), plain)
+
+        response = cached_view(self.factory.get('/page/'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, plain)
+        self.assertEqual(view.calls, 1)
+
+    def test_gzip_variant_has_weak_etag(self):
+        '''ETag сжатой копии слабый, несжатой - сильный.'''
+        view = CountingView()
+        cached_view = condition(etag_func=lambda request: 'page')(
+            self.cached(view)
+        )
+
+        response = cached_view(self.factory.get('/page/'))
+        self.assertEqual(response['ETag'], '"page"')
+        for _ in range(2):
+            response = cached_view(self.factory.get(
+                '/page/', HTTP_ACCEPT_ENCODING='gzip'
+            ))
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(response['ETag'], 'W/"page"')
+        response = cached_view(self.factory.get(
+            '/page/', HTTP_ACCEPT_ENCODING='gzip',
+            HTTP_IF_NONE_MATCH='W/"page"',
+        ))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(view.calls, 1)
+
+    def test_shell_gzip_matches_plain(self):
+        '''Сжатая страница из кусков каркаса и дыр - корректный gzip.'''
+        content = (
+            '<p>До шапки</p><!--hole:0--><p>Между</p>'
+            '<!--hole:1--><p>После</p>' * 50
+        ).encode()
+        shell = Shell(content, [('header', {}), ('header', {})], 'utf-8')
+        request = self.factory.get('/page/')
+        request.user = AnonymousUser()
+
+        plain = shell.render(request)
+        self.assertNotIn(b'<!--hole:', plain)
+        self.assertIn('Войти'.encode(), plain)
+        self.assertEqual(gzip.decompress(shell.render_gzip(request)), plain)
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+from http import HTTPStatus
+
+from django.conf import settings
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+
+TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
+
+HASHED_NAME = 'posts/ab/cd/abcd' + '0' * 60 + '.txt'
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class MediaViewTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        for name in ('plain.txt', HASHED_NAME):
+            path = os.path.join(TEMP_MEDIA_ROOT, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as file:
+                file.write(b'0123456789')
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        self.guest_client = Client()
+
+    def get(self, name, **headers):
+        return self.guest_client.get(
+            reverse('media', kwargs={'path': name}), **headers
+        )
+
+    def test_full_file_and_not_modified(self):
+        '''Файл отдается целиком, повтор с ETag - 304.'''
+        response = self.get('plain.txt')
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('Last-Modified', response)
+
+        response = self.get(
+            'plain.txt', HTTP_IF_NONE_MATCH=response['ETag']
+        )
+        self.assertEqual(response.status_code, HTTPStatus.NOT_MODIFIED)
+
+    def test_range(self):
+        '''Range отдает часть файла, невыполнимый Range - 416.'''
+        response = self.get('plain.txt', HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, HTTPStatus.PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content), b'234')
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+
+        response = self.get('plain.txt', HTTP_RANGE='bytes=-3')
+        self.assertEqual(b''.join(response.streaming_content), b'789')
+
+        response = self.get('plain.txt', HTTP_RANGE='bytes=20-')
+        self.assertEqual(
+            response.status_code,
+            HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+        )
+
+        # If-Range с чужим ETag: файл целиком
+        response = self.get(
+            'plain.txt', HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"old"'
+        )
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+
+    def test_hashed_name_is_immutable(self):
+        '''Файл с именем по хешу кешируется навсегда.'''
+        response = self.get(HASHED_NAME)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(response['ETag'], '"abcd' + '0' * 60 + '"')
+
+    @override_settings(MEDIA_SENDFILE='x-accel-redirect')
+    def test_accel_redirect(self):
+        '''В режиме X-Accel-Redirect файл отдает прокси.'''
+        response = self.get('plain.txt')
+        self.assertEqual(
+            response['X-Accel-Redirect'],
+            settings.MEDIA_ACCEL_PREFIX + 'plain.txt'
+        )
+        self.assertEqual(response.content, b'')
+
+    def test_missing_and_outside_files(self):
+        '''Несуществующие файлы и выход за MEDIA_ROOT - 404.'''
+        for name in ('missing.txt', '../manage.py', 'posts'):
+            with self.subTest(name=name):
+                response = self.get(name)
+                self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
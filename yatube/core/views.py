@@ -1,6 +1,25 @@
+import mimetypes
+import os
+import re
 from http import HTTPStatus
+from stat import S_ISREG
+from urllib.parse import quote
 
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import (FileResponse, Http404, HttpResponse,
+                         StreamingHttpResponse)
 from django.shortcuts import render
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+from .storage import is_hashed_name
+
+RANGE_RE = re.compile(r'^\s*bytes=(\d*)-(\d*)\s*$')
+
+MEDIA_CHUNK_SIZE = 64 * 1024
 
 
 def page_not_found(request, exception):
@@ -26,3 +45,132 @@ def permission_denied(request, exception):
 
 def csrf_failure(request, reason=''):
     return render(request, 'core/403csrf.html')
+
+
+def _parse_range(header: str, size: int):
+    '''
+    Разбираем заголовок Range с одним диапазоном байт.
+    Возвращаем (начало, конец включительно), None - если заголовок
+    не понят (отдаем файл целиком), или False - если диапазон
+    за пределами файла.
+    '''
+
+    match = RANGE_RE.match(header)
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first:
+        # bytes=-N: последние N байт
+        if not last or not int(last):
+            return False
+        return max(size - int(last), 0), size - 1
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first > last:
+        return False
+    return first, last
+
+
+def _file_chunks(path: str, start: int, length: int):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(MEDIA_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _sendfile_response(path: str, full_path: str, content_type: str):
+    '''Пустой ответ: Range и отдачу файла берет на себя прокси.'''
+
+    response = HttpResponse(content_type=content_type)
+    if settings.MEDIA_SENDFILE == 'x-accel-redirect':
+        response['X-Accel-Redirect'] = (
+            settings.MEDIA_ACCEL_PREFIX + quote(path)
+        )
+    else:
+        response['X-Sendfile'] = full_path
+    return response
+
+
+def _file_response(request, full_path: str, size: int, validators: tuple,
+                   content_type: str):
+    '''Файл целиком или диапазон байт из заголовка Range.'''
+
+    byte_range = None
+    # If-Range: диапазон, только если файл не изменился
+    if 'HTTP_RANGE' in request.META and request.META.get(
+        'HTTP_IF_RANGE', validators[0]
+    ) in validators:
+        byte_range = _parse_range(request.META['HTTP_RANGE'], size)
+
+    if byte_range is False:
+        response = HttpResponse(
+            status=HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+        )
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if byte_range is None:
+        return FileResponse(open(full_path, 'rb'), content_type=content_type)
+
+    first, last = byte_range
+    length = last - first + 1
+    response = StreamingHttpResponse(
+        _file_chunks(full_path, first, length),
+        status=HTTPStatus.PARTIAL_CONTENT,
+        content_type=content_type,
+    )
+    response['Content-Range'] = f'bytes {first}-{last}/{size}'
+    response['Content-Length'] = str(length)
+    return response
+
+
+@require_safe
+def serve_media(request, path):
+    '''
+    Отдаем файл из MEDIA_ROOT с ETag, Last-Modified и Range.
+    Файлы с именем по хешу содержимого не меняются и кешируются
+    навсегда. В режиме MEDIA_SENDFILE байты копирует прокси
+    по заголовку X-Accel-Redirect или X-Sendfile.
+    '''
+
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(full_path)
+    except (SuspiciousFileOperation, OSError):
+        raise Http404
+    if not S_ISREG(stat.st_mode):
+        raise Http404
+
+    if is_hashed_name(path):
+        etag = '"{}"'.format(os.path.splitext(os.path.basename(path))[0])
+        cache_control = {'max_age': 60 * 60 * 24 * 365, 'immutable': True}
+    else:
+        etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+        cache_control = {'max_age': settings.MEDIA_CACHE_MAX_AGE}
+    last_modified = int(stat.st_mtime)
+
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified
+    )
+    if response is None:
+        content_type, encoding = mimetypes.guess_type(full_path)
+        content_type = content_type or 'application/octet-stream'
+        if settings.MEDIA_SENDFILE:
+            response = _sendfile_response(path, full_path, content_type)
+        else:
+            response = _file_response(
+                request, full_path, stat.st_size,
+                (etag, http_date(last_modified)), content_type,
+            )
+        if encoding:
+            response['Content-Encoding'] = encoding
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    patch_cache_control(response, public=True, **cache_control)
+    return response
@@ -1,6 +1,7 @@
 from django.contrib import admin
 
 from .models import Group, Post
+from .search import match_posts
 
 
 class PostAdmin(admin.ModelAdmin):
@@ -10,6 +11,12 @@ class PostAdmin(admin.ModelAdmin):
     list_editable = ('group',)
     empty_value_display = '-пусто-'
 
+    def get_search_results(self, request, queryset, search_term):
+        # поиск по тексту идет через полнотекстовый индекс
+        if not search_term:
+            return queryset, False
+        return match_posts(queryset, search_term), False
+
 
 class GroupAdmin(admin.ModelAdmin):
     list_display = ('title', 'slug',)
@@ -1,5 +1,22 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import post_migrate
+
+
+def restore_search_index(sender, using, **kwargs):
+    from .search import ensure_search_index
+    ensure_search_index(connections[using])
 
 
 class PostsConfig(AppConfig):
     name = 'posts'
+
+    def ready(self):
+        # регистрируем обработчики сигналов
+        from . import signals  # noqa: F401
+
+        # и личные части страниц для core.holes
+        from . import holes  # noqa: F401
+
+        # SQLite теряет триггеры поиска при пересоздании таблиц
+        post_migrate.connect(restore_search_index, sender=self)
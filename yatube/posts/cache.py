@@ -0,0 +1,156 @@
+'''Ключи версий закешированных страниц приложения posts.'''
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+from core.cache import bump_versions
+
+from .models import Follow, Group, Post
+
+User = get_user_model()
+
+INDEX_VERSION_KEY = 'index_page.version'
+
+# Общее кол-во постов для пагинации главной. Для групп и авторов
+# есть денормализованные счетчики, см. posts.counters
+POSTS_COUNT_KEY = 'posts_count'
+
+
+def follow_version_key(user_id: int) -> str:
+    return f'follow_page.version.{user_id}'
+
+
+def follow_version_keys(request) -> list:
+    return [follow_version_key(request.user.pk)]
+
+
+def group_version_key(slug: str) -> str:
+    return f'group_page.version.{slug}'
+
+
+def profile_version_key(username: str) -> str:
+    return f'profile_page.version.{username}'
+
+
+def post_version_key(post_id: int) -> str:
+    return f'post_page.version.{post_id}'
+
+
+def author_cards_version_key(author_id: int) -> str:
+    return f'post_info.version.author.{author_id}'
+
+
+def group_cards_version_key(group_id: int) -> str:
+    return f'post_info.version.group.{group_id}'
+
+
+def group_version_keys(request, slug) -> list:
+    return [group_version_key(slug)]
+
+
+def profile_version_keys(request, username) -> list:
+    return [profile_version_key(username)]
+
+
+def post_version_keys(request, post_id) -> list:
+    return [post_version_key(post_id)]
+
+
+def invalidate_index() -> None:
+    bump_versions([INDEX_VERSION_KEY])
+
+
+def invalidate_posts_count() -> None:
+    cache.delete(POSTS_COUNT_KEY)
+
+
+def invalidate_follow_page(user_id: int) -> None:
+    bump_versions([follow_version_key(user_id)])
+
+
+def invalidate_followers_pages(author_id: int) -> None:
+    '''Сбрасываем ленты всех подписчиков автора одним set_many.'''
+    bump_versions(
+        follow_version_key(user_id)
+        for user_id in Follow.objects.filter(
+            author_id=author_id
+        ).values_list('user_id', flat=True).iterator()
+    )
+
+
+def invalidate_group_pages(group_ids) -> None:
+    ids = [pk for pk in group_ids if pk]
+    if ids:
+        bump_versions(
+            group_version_key(slug)
+            for slug in Group.objects.filter(
+                pk__in=ids
+            ).values_list('slug', flat=True)
+        )
+
+
+def invalidate_group_page(slug: str) -> None:
+    bump_versions([group_version_key(slug)])
+
+
+def invalidate_profile_pages(user_ids) -> None:
+    bump_versions(
+        profile_version_key(username)
+        for username in User.objects.filter(
+            pk__in=list(user_ids)
+        ).values_list('username', flat=True)
+    )
+
+
+def invalidate_post_pages(post_ids) -> None:
+    bump_versions(post_version_key(post_id) for post_id in post_ids)
+
+
+def invalidate_author_pages(author_id: int) -> None:
+    '''
+    Имя и кол-во постов автора есть на страницах всех его постов
+    и групп, где он писал: сбрасываем их все.
+    '''
+    posts = Post.objects.filter(author_id=author_id).order_by()
+    invalidate_post_pages(posts.values_list('pk', flat=True).iterator())
+    invalidate_group_pages(
+        posts.values_list('group_id', flat=True).distinct()
+    )
+
+
+def invalidate_group_posts_pages(group_id: int) -> None:
+    '''
+    Адрес и название группы есть на страницах всех ее постов,
+    в профилях их авторов и в лентах подписчиков этих авторов.
+    '''
+    posts = Post.objects.filter(group_id=group_id).order_by()
+    invalidate_post_pages(posts.values_list('pk', flat=True).iterator())
+    author_ids = set(posts.values_list('author_id', flat=True).distinct())
+    invalidate_profile_pages(author_ids)
+    for author_id in author_ids:
+        invalidate_followers_pages(author_id)
+
+
+def invalidate_author_cards(author_id: int) -> None:
+    '''Имя автора есть на карточках всех его постов.'''
+    bump_versions([author_cards_version_key(author_id)])
+
+
+def invalidate_group_cards(group_id: int) -> None:
+    bump_versions([group_cards_version_key(group_id)])
+
+
+def invalidate_posts_pages(posts) -> None:
+    '''
+    Сбрасываем разом все страницы, где показаны posts: для правок
+    в обход сигналов (update, bulk_update) целыми пачками.
+    '''
+    posts = list(posts)
+    if not posts:
+        return
+    author_ids = {post.author_id for post in posts}
+    invalidate_index()
+    invalidate_post_pages(post.pk for post in posts)
+    invalidate_group_pages({post.group_id for post in posts})
+    invalidate_profile_pages(author_ids)
+    for author_id in author_ids:
+        invalidate_followers_pages(author_id)
@@ -0,0 +1,125 @@
+'''
+Валидаторы условных GET-запросов (ETag, Last-Modified)
+для страниц поста, автора и группы.
+
+Состояние страницы достается одним агрегирующим запросом, до
+выборки постов и рендеринга шаблона. Страницы отличаются у разных
+пользователей (шапка, кнопка подписки, форма комментария),
+поэтому ETag включает pk пользователя. Имя автора, название группы
+и прочее, чего нет в состоянии, меняют версии кеша страниц из
+posts.cache: их ETag тоже включает.
+'''
+import hashlib
+from typing import Optional
+
+from django.contrib.auth import get_user_model
+from django.db.models import Max
+
+from core.cache import get_versions
+
+from .cache import group_version_keys, post_version_keys, profile_version_keys
+from .models import Follow, Group, Post
+
+User = get_user_model()
+
+
+def _memo(request, key, load):
+    '''
+    condition() вызывает функции ETag и Last-Modified по очереди,
+    состояние страницы запоминаем на объекте запроса.
+    '''
+
+    states = request.__dict__.setdefault('_condition_states', {})
+    if key not in states:
+        states[key] = load()
+    return states[key]
+
+
+def _etag(*parts) -> str:
+    return hashlib.md5(repr(parts).encode()).hexdigest()
+
+
+def _latest(*dates):
+    dates = [date for date in dates if date is not None]
+    return max(dates) if dates else None
+
+
+def _post_state(request, post_id):
+    # (изменен, кол-во комментариев, последний комментарий,
+    # кол-во постов автора)
+    return _memo(request, ('post', post_id), lambda: Post.objects.filter(
+        pk=post_id
+    ).order_by().annotate(
+        last_comment=Max('comments__created')
+    ).values_list(
+        'updated', 'comments_count', 'last_comment',
+        'author__counters__posts_count',
+    ).first())
+
+
+def post_detail_etag(request, post_id) -> Optional[str]:
+    state = _post_state(request, post_id)
+    if state is None:
+        return None
+    return _etag(
+        'post', post_id, *state, request.user.pk,
+        *get_versions(post_version_keys(request, post_id)),
+    )
+
+
+def post_detail_last_modified(request, post_id):
+    state = _post_state(request, post_id)
+    return state and _latest(state[0], state[2])
+
+
+def _profile_state(request, username):
+    def load():
+        state = User.objects.filter(username=username).annotate(
+            last_post=Max('posts__updated')
+        ).values_list('pk', 'last_post', 'counters__posts_count').first()
+        if state is None or not request.user.is_authenticated:
+            return state
+        following = Follow.objects.filter(
+            user=request.user, author_id=state[0]
+        ).exists()
+        return (*state, following)
+
+    return _memo(request, ('profile', username), load)
+
+
+def profile_etag(request, username) -> Optional[str]:
+    state = _profile_state(request, username)
+    if state is None:
+        return None
+    return _etag(
+        'profile', *state, request.user.pk,
+        *get_versions(profile_version_keys(request, username)),
+    )
+
+
+def profile_last_modified(request, username):
+    state = _profile_state(request, username)
+    return state and state[1]
+
+
+def _group_state(request, slug):
+    return _memo(request, ('group', slug), lambda: Group.objects.filter(
+        slug=slug
+    ).annotate(
+        last_post=Max('posts__updated')
+    ).values_list('pk', 'last_post', 'posts_count').first())
+
+
+def group_etag(request, slug) -> Optional[str]:
+    state = _group_state(request, slug)
+    if state is None:
+        return None
+    return _etag(
+        'group', *state, request.user.pk,
+        *get_versions(group_version_keys(request, slug)),
+    )
+
+
+def group_last_modified(request, slug):
+    state = _group_state(request, slug)
+    return state and state[1]
@@ -0,0 +1,148 @@
+'''
+Денормализованные счетчики постов, комментариев и подписок.
+
+Счетчики меняются атомарно выражениями F() из обработчиков
+сигналов (см. posts.signals). bulk_create и update() сигналов
+не отправляют, после них счетчики чинит команда recount_counters.
+'''
+from typing import Iterable, List
+
+from django.contrib.auth import get_user_model
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import Comment, Follow, Group, Post, UserCounters
+
+User = get_user_model()
+
+
+def _count(queryset, field: str) -> Coalesce:
+    '''Подзапрос: кол-во строк queryset, где field = pk внешней строки.'''
+
+    return Coalesce(
+        Subquery(
+            queryset.filter(**{field: OuterRef('pk')}).order_by().values(
+                field
+            ).annotate(total=Count('pk')).values('total'),
+            output_field=IntegerField(),
+        ),
+        0
+    )
+
+
+def recount_users(user_ids: Iterable[int]) -> None:
+    '''Пересчитываем счетчики пользователей с нуля.'''
+
+    users = User.objects.filter(pk__in=list(user_ids)).annotate(
+        posts_total=_count(Post.objects.all(), 'author'),
+        followers_total=_count(Follow.objects.all(), 'author'),
+        following_total=_count(Follow.objects.all(), 'user'),
+    ).values_list('pk', 'posts_total', 'followers_total', 'following_total')
+
+    counters = [
+        UserCounters(
+            user_id=pk,
+            posts_count=posts,
+            followers_count=followers,
+            following_count=following,
+        )
+        for pk, posts, followers, following in users
+    ]
+    existing = set(UserCounters.objects.filter(
+        pk__in=[item.user_id for item in counters]
+    ).values_list('pk', flat=True))
+
+    UserCounters.objects.bulk_create(
+        [item for item in counters if item.user_id not in existing]
+    )
+    UserCounters.objects.bulk_update(
+        [item for item in counters if item.user_id in existing],
+        ['posts_count', 'followers_count', 'following_count'],
+    )
+
+
+def recount_groups(group_ids: Iterable[int]) -> None:
+    '''Пересчитываем кол-во постов в группах.'''
+
+    groups: List[Group] = list(Group.objects.filter(
+        pk__in=list(group_ids)
+    ).annotate(
+        posts_total=_count(Post.objects.all(), 'group')
+    ).only('pk'))
+    for group in groups:
+        group.posts_count = group.posts_total
+    Group.objects.bulk_update(groups, ['posts_count'])
+
+
+def recount_posts(post_ids: Iterable[int]) -> None:
+    '''Пересчитываем кол-во комментариев к постам.'''
+
+    posts: List[Post] = list(Post.objects.filter(
+        pk__in=list(post_ids)
+    ).annotate(
+        comments_total=_count(Comment.objects.all(), 'post')
+    ).only('pk'))
+    for post in posts:
+        post.comments_count = post.comments_total
+    Post.objects.bulk_update(posts, ['comments_count'])
+
+
+def get_user_counters(user) -> UserCounters:
+    '''Счетчики пользователя; если строки нет, создаем ее.'''
+
+    try:
+        return user.counters
+    except UserCounters.DoesNotExist:
+        recount_users([user.pk])
+        return UserCounters.objects.get(pk=user.pk)
+
+
+def _shift(field: str, delta: int) -> Greatest:
+    # счетчик мог разойтись с БД после bulk-операций
+    return Greatest(F(field) + delta, 0)
+
+
+def change_user_counters(user_id: int, **deltas) -> None:
+    '''Атомарно сдвигаем счетчики пользователя на deltas.'''
+
+    updated = UserCounters.objects.filter(user_id=user_id).update(**{
+        field: _shift(field, delta) for field, delta in deltas.items()
+    })
+    # строки еще нет: считаем с нуля, изменение уже в БД.
+    # При уменьшении строки может не быть из-за удаления пользователя.
+    if not updated and any(delta > 0 for delta in deltas.values()):
+        recount_users([user_id])
+
+
+def change_group_posts(group_id: int, delta: int) -> None:
+    if group_id is not None:
+        Group.objects.filter(pk=group_id).update(
+            posts_count=_shift('posts_count', delta)
+        )
+
+
+def post_saved(post: Post, created: bool) -> None:
+    if created:
+        change_user_counters(post.author_id, posts_count=1)
+        change_group_posts(post.group_id, 1)
+    elif hasattr(post, '_counted_group_id'):
+        if post._counted_group_id != post.group_id:
+            change_group_posts(post._counted_group_id, -1)
+            change_group_posts(post.group_id, 1)
+    post._counted_group_id = post.group_id
+
+
+def post_deleted(post: Post) -> None:
+    change_user_counters(post.author_id, posts_count=-1)
+    change_group_posts(post.group_id, -1)
+
+
+def comment_changed(comment: Comment, delta: int) -> None:
+    Post.objects.filter(pk=comment.post_id).update(
+        comments_count=_shift('comments_count', delta)
+    )
+
+
+def follow_changed(follow: Follow, delta: int) -> None:
+    change_user_counters(follow.user_id, following_count=delta)
+    change_user_counters(follow.author_id, followers_count=delta)
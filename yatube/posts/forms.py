@@ -1,6 +1,8 @@
 from django import forms
+from django.conf import settings
+from django.template.defaultfilters import filesizeformat
 
-from .models import Comment, Post
+from .models import Comment, Group, Post
 
 
 class PostForm(forms.ModelForm):
@@ -8,8 +10,45 @@ class PostForm(forms.ModelForm):
         model = Post
         fields = ('text', 'group', 'image')
 
+    def clean_image(self):
+        image = self.cleaned_data['image']
+        # новая загрузка: ImageField формы уже прочитал заголовок
+        pil_image = getattr(image, 'image', None)
+        if pil_image is None:
+            return image
+        if image.size > settings.POST_IMAGE_MAX_SIZE:
+            raise forms.ValidationError(
+                'Файл больше %s' % filesizeformat(
+                    settings.POST_IMAGE_MAX_SIZE
+                )
+            )
+        width, height = pil_image.size
+        if width * height > settings.POST_IMAGE_MAX_PIXELS:
+            raise forms.ValidationError(
+                'Картинка слишком большая: %dx%d пикселей' % (width, height)
+            )
+        return image
+
 
 class CommentForm(forms.ModelForm):
     class Meta:
         model = Comment
         fields = ('text',)
+
+
+class SearchForm(forms.Form):
+    q = forms.CharField(
+        label='Поиск',
+        max_length=200,
+    )
+    group = forms.ModelChoiceField(
+        label='Группа',
+        queryset=Group.objects.all(),
+        to_field_name='slug',
+        required=False,
+    )
+    author = forms.CharField(
+        label='Автор',
+        max_length=150,
+        required=False,
+    )
@@ -0,0 +1,75 @@
+'''
+Кеш отрендеренных карточек постов (posts/includes/post_info.html).
+
+Ключ карточки включает Post.updated, поэтому правка поста
+делает старую карточку недостижимой без явного удаления.
+Имя автора и группа на карточке меняются без правки поста:
+в ключ входят и их версии, которые сбрасывают сигналы.
+'''
+from typing import Dict, Iterable
+
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from core.cache import get_versions
+
+from .cache import author_cards_version_key, group_cards_version_key
+from .images import prefetch_thumbnails
+from .models import Post
+
+POST_INFO_TEMPLATE = 'posts/includes/post_info.html'
+
+
+def post_fragment_key(post: Post, versions: Dict[str, str]) -> str:
+    return 'post_info.{}.{}.{}.{}.{}'.format(
+        post.pk,
+        post.updated.timestamp(),
+        post.group_id,
+        versions[author_cards_version_key(post.author_id)],
+        versions[group_cards_version_key(post.group_id)]
+        if post.group_id else '',
+    )
+
+
+def _card_version_keys(posts: Iterable[Post]) -> list:
+    keys = {author_cards_version_key(post.author_id) for post in posts}
+    keys.update(
+        group_cards_version_key(post.group_id)
+        for post in posts if post.group_id
+    )
+    return sorted(keys)
+
+
+def render_post_fragments(posts: Iterable[Post]) -> None:
+    '''
+    Кладем в post.fragment готовую карточку каждого поста страницы.
+    Из кеша карточки достаются одним get_many, недостающие
+    рендерятся и сохраняются одним set_many.
+    '''
+
+    posts = list(posts)
+    version_keys = _card_version_keys(posts)
+    versions = dict(zip(version_keys, get_versions(version_keys)))
+    posts_by_key = {
+        post_fragment_key(post, versions): post for post in posts
+    }
+    fragments = cache.get_many(list(posts_by_key))
+
+    # миниатюры недостающих карточек ищем разом
+    prefetch_thumbnails(
+        post for key, post in posts_by_key.items() if key not in fragments
+    )
+
+    missing = {}
+    for key, post in posts_by_key.items():
+        if key not in fragments:
+            missing[key] = render_to_string(
+                POST_INFO_TEMPLATE,
+                {'post': post}
+            )
+        post.fragment = mark_safe(fragments.get(key) or missing[key])
+
+    if missing:
+        cache.set_many(missing, settings.POST_FRAGMENT_CACHE_TIMEOUT)
@@ -0,0 +1,42 @@
+'''Личные части страниц posts, см. core.holes.'''
+from core.holes import register
+
+from .forms import CommentForm
+from .models import Follow, UserCounters
+
+
+@register('switcher', 'posts/includes/switcher.html')
+def switcher_context(request):
+    return {}
+
+
+@register('follow_button', 'posts/includes/follow_button.html')
+def follow_button_context(request, username):
+    user = request.user
+    following = (
+        user.is_authenticated
+        and user.username != username
+        and Follow.objects.filter(
+            user=user, author__username=username
+        ).exists()
+    )
+    return {'username': username, 'following': following}
+
+
+@register('post_tools', 'posts/includes/post_tools.html')
+def post_tools_context(request, post_id, author_id):
+    return {
+        'post_id': post_id,
+        'author_id': author_id,
+        'form': CommentForm(),
+    }
+
+
+@register('author_posts_count', 'posts/includes/author_posts_count.html')
+def author_posts_count_context(request, author_id):
+    # меняется с каждым постом автора: в каркасе страниц всех
+    # его постов устаревал бы, а сбрасывать их все накладно
+    posts_count = UserCounters.objects.filter(
+        user_id=author_id
+    ).values_list('posts_count', flat=True).first()
+    return {'posts_count': posts_count or 0}
@@ -0,0 +1,278 @@
+'''
+Предварительная генерация миниатюр картинок постов.
+
+Шаблоны вызывают {% thumbnail %} при рендеринге, и первый запрос
+после загрузки картинки декодировал и уменьшал ее прямо в запросе.
+Теперь миниатюры всех геометрий из POST_THUMBNAILS готовятся
+в пуле потоков сразу после сохранения поста, а шаблону остается
+найти готовую миниатюру в хранилище ключей sorl.
+
+Кроме того, картинка нарезается на варианты разной ширины
+(POST_IMAGE_WIDTHS) в JPEG и, если Pillow умеет, в WebP. Имена
+вариантов записываются в Post.image_variants, и шаблоны строят
+srcset по этому манифесту, не трогая файловую систему.
+
+Размеры исходной картинки и крошечная заглушка для ленивой загрузки
+считаются один раз при сохранении поста (describe_image).
+
+Для постов без манифеста prefetch_thumbnails находит миниатюры
+всей страницы разом, а не по запросу к хранилищу ключей на тег.
+'''
+import base64
+import io
+import json
+import logging
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Iterable, List
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+from PIL import Image, features
+from sorl.thumbnail import default, delete, get_thumbnail
+from sorl.thumbnail.conf import defaults as sorl_defaults
+from sorl.thumbnail.conf import settings as sorl_settings
+from sorl.thumbnail.images import ImageFile, deserialize_image_file
+from sorl.thumbnail.kvstores.base import add_prefix
+from sorl.thumbnail.kvstores.cached_db_kvstore import EMPTY_VALUE
+from sorl.thumbnail.kvstores.cached_db_kvstore import \
+    KVStore as CachedDBKVStore
+from sorl.thumbnail.models import KVStore as KVStoreModel
+
+from .cache import invalidate_posts_pages
+from .models import Post
+
+logger = logging.getLogger(__name__)
+
+# Геометрии и опции миниатюр из шаблона posts/includes/post_image.html
+# (пока у поста нет манифеста). Меняя шаблон, меняйте и этот список.
+# Картинка не обрезается: ее высоту на странице шаблон считает
+# по сохраненным размерам исходной (Post.image_width, image_height)
+POST_THUMBNAILS = (
+    ('960', {'upscale': True}),
+)
+
+# Ширины вариантов картинки для srcset, по возрастанию.
+# Пропорции исходной картинки, как и у миниатюры
+POST_IMAGE_WIDTHS = (480, 768, 960)
+
+VARIANT_FORMATS = ('JPEG', 'WEBP') if features.check('webp') else ('JPEG',)
+
+# Наибольшая сторона заглушки, пикселей
+PLACEHOLDER_SIZE = 16
+
+IMAGE_METADATA_FIELDS = (
+    'image_width', 'image_height', 'image_size', 'image_placeholder'
+)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> Executor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.THUMBNAIL_WORKERS,
+                thread_name_prefix='thumbnails',
+            )
+        return _executor
+
+
+def generate_thumbnails(name: str, force: bool = False) -> bool:
+    '''
+    Создаем миниатюры картинки name для всех геометрий.
+    Уже созданные миниатюры находятся в хранилище ключей sorl
+    и не пересоздаются, если не передан force.
+    Затем обновляем манифест вариантов у постов с этой картинкой.
+    Возвращаем False, если исходного файла нет.
+    '''
+
+    source = ImageFile(name, Post.image.field.storage)
+    if not source.exists():
+        return False
+    if force:
+        # удаляет и файлы миниатюр, и их ключи
+        delete(source, delete_file=False)
+    for geometry, options in POST_THUMBNAILS:
+        get_thumbnail(source, geometry, **options)
+    store_variants(name, build_variants(source))
+    return True
+
+
+def build_variants(source: ImageFile) -> List[list]:
+    '''Нарезаем варианты картинки: [ширина, высота, JPEG, WebP или ''].'''
+
+    variants = []
+    for width in POST_IMAGE_WIDTHS:
+        thumbnails = [
+            get_thumbnail(
+                source, str(width), upscale=True, format=image_format
+            )
+            for image_format in VARIANT_FORMATS
+        ]
+        jpeg, webp = ([thumbnail.name for thumbnail in thumbnails] + [''])[:2]
+        variants.append([width, thumbnails[0].height, jpeg, webp])
+    return variants
+
+
+def store_variants(name: str, variants: List[list]) -> None:
+    '''
+    Записываем манифест постам с картинкой name одним bulk_update,
+    а не save(): сигналы поста (лента, счетчики, сброс страниц)
+    на каждый пост при проходе по всей библиотеке не нужны,
+    страницы всех постов картинки сбрасываем разом.
+    '''
+
+    manifest = json.dumps({'n': name, 'v': variants}, separators=(',', ':'))
+    posts = list(Post.objects.filter(image=name).exclude(
+        image_variants=manifest
+    ).only('pk', 'author_id', 'group_id'))
+    now = timezone.now()
+    for post in posts:
+        post.image_variants = manifest
+        # новое updated меняет и ключи закешированных карточек
+        post.updated = now
+    Post.objects.bulk_update(posts, ['image_variants', 'updated'])
+    invalidate_posts_pages(posts)
+
+
+def describe_image(file) -> dict:
+    '''
+    Размеры картинки и заглушка - data URI крошечной PNG-копии.
+    Файл читается с начала, позиция после чтения тоже в начале.
+    '''
+
+    file.seek(0)
+    try:
+        with Image.open(file) as image:
+            width, height = image.size
+            # JPEG сразу декодируется в уменьшенном виде
+            image.draft('RGB', (PLACEHOLDER_SIZE * 4, PLACEHOLDER_SIZE * 4))
+            preview = image.convert('RGB')
+    finally:
+        file.seek(0)
+    preview.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    buffer = io.BytesIO()
+    preview.save(buffer, 'PNG', optimize=True)
+    return {
+        'image_width': width,
+        'image_height': height,
+        'image_size': file.size,
+        'image_placeholder': 'data:image/png;base64,' + base64.b64encode(
+            buffer.getvalue()
+        ).decode(),
+    }
+
+
+def describe_post_image(post: Post) -> None:
+    '''Заполняем у поста размеры и заглушку его картинки.'''
+
+    values = dict.fromkeys(IMAGE_METADATA_FIELDS)
+    values['image_placeholder'] = ''
+    if post.image:
+        try:
+            values = describe_image(post.image.file)
+        except (OSError, ValueError, SyntaxError):
+            # битая картинка или файла нет: метаданные не нужны
+            logger.warning('Не удалось прочитать картинку %s',
+                           post.image.name)
+        finally:
+            if post.image._committed:
+                post.image.close()
+    for field, value in values.items():
+        setattr(post, field, value)
+
+
+def thumbnail_file(source, geometry: str, **options) -> ImageFile:
+    '''
+    Файл миниатюры, который создал бы get_thumbnail, без обращения
+    к хранилищу ключей. Опции дополняются так же, как в sorl.
+    '''
+
+    backend = default.backend
+    source = ImageFile(source)
+    if sorl_settings.THUMBNAIL_PRESERVE_FORMAT:
+        options.setdefault('format', backend._get_format(source))
+    for key, value in backend.default_options.items():
+        options.setdefault(key, value)
+    for key, attr in backend.extra_options:
+        value = getattr(sorl_settings, attr)
+        if value != getattr(sorl_defaults, attr):
+            options.setdefault(key, value)
+    name = backend._get_thumbnail_filename(source, geometry, options)
+    return ImageFile(name, default.storage)
+
+
+def prefetch_thumbnails(posts: Iterable[Post]) -> None:
+    '''
+    Кладем в post.thumbnail готовую миниатюру шириной 960 каждого поста
+    без манифеста вариантов: записи хранилища ключей sorl достаются
+    одним get_many из кеша и одним запросом к БД для промахов.
+    Если миниатюры еще нет, post.thumbnail = None, и шаблон
+    создает ее тегом {% thumbnail %}.
+    '''
+
+    if not isinstance(default.kvstore, CachedDBKVStore):
+        return
+    geometry, options = POST_THUMBNAILS[0]
+    wanted = {}
+    for post in posts:
+        post.thumbnail = None
+        if post.image and post.image_sources is None:
+            thumbnail = thumbnail_file(post.image, geometry, **options)
+            wanted.setdefault(add_prefix(thumbnail.key), []).append(post)
+    if not wanted:
+        return
+
+    kv_cache = default.kvstore.cache
+    values = kv_cache.get_many(list(wanted))
+    missing = [key for key in wanted if key not in values]
+    if missing:
+        found = dict(KVStoreModel.objects.filter(
+            key__in=missing
+        ).values_list('key', 'value'))
+        # как и sorl, запоминаем отсутствие записи
+        kv_cache.set_many(
+            {key: found.get(key, EMPTY_VALUE) for key in missing},
+            sorl_settings.THUMBNAIL_CACHE_TIMEOUT
+        )
+        values.update(found)
+
+    for key, value in values.items():
+        if value and value != EMPTY_VALUE:
+            thumbnail = deserialize_image_file(value)
+            for post in wanted[key]:
+                post.thumbnail = thumbnail
+
+
+def _generate_in_worker(name: str) -> None:
+    try:
+        generate_thumbnails(name)
+    except Exception:
+        logger.exception('Не удалось создать миниатюры %s', name)
+    finally:
+        # соединения с БД у потоков пула свои
+        connections.close_all()
+
+
+def enqueue_thumbnails(post: Post) -> None:
+    '''
+    Ставим генерацию миниатюр картинки поста в очередь пула
+    после фиксации транзакции. При THUMBNAIL_WORKERS = 0
+    миниатюры создаются сразу, в текущем потоке.
+    '''
+
+    if not post.image:
+        return
+    name = post.image.name
+
+    def submit():
+        if settings.THUMBNAIL_WORKERS:
+            get_executor().submit(_generate_in_worker, name)
+        else:
+            generate_thumbnails(name)
+
+    transaction.on_commit(submit)
@@ -0,0 +1,177 @@
+'''
+Прием загруженных картинок постов вне потока запроса.
+
+Загрузка приходит на диск кусками (FILE_UPLOAD_HANDLERS), форма
+проверяет только заголовок картинки. Пост сохраняется без новой
+картинки, а ее копия перекодируется в пуле процессов: бюджет
+пикселей защищает от декомпрессионных бомб, метаданные (EXIF,
+текстовые блоки PNG) не переносятся. Готовый файл прикрепляется
+к посту из пула потоков posts.images, поэтому всплеск больших
+загрузок не занимает ни потоки, ни память веб-воркеров.
+'''
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Optional
+
+from django.conf import settings
+from django.core.files import File
+from django.db import connections, transaction
+from PIL import Image, ImageOps
+
+from .images import (IMAGE_METADATA_FIELDS, describe_post_image,
+                     enqueue_thumbnails, get_executor)
+from .models import Post
+
+logger = logging.getLogger(__name__)
+
+# Форматы, которые сохраняются как есть; остальные - в PNG
+KEEP_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+
+SAVE_OPTIONS = {
+    'JPEG': {'quality': 90, 'optimize': True},
+    'PNG': {'optimize': True},
+}
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def get_process_pool() -> Executor:
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=settings.IMAGE_INGEST_WORKERS
+            )
+        return _process_pool
+
+
+def reencode_image(source_path: str, max_pixels: int) -> str:
+    '''
+    Перекодируем картинку без метаданных в файл рядом с исходным.
+    Выполняется в процессе пула, поэтому не трогает Django.
+    Возвращаем путь к новому файлу.
+    '''
+
+    with Image.open(source_path) as image:
+        # заголовок уже прочитан, пиксели еще нет
+        if image.width * image.height > max_pixels:
+            raise ImageTooLarge(f'{image.width}x{image.height}')
+        image_format = (
+            image.format if image.format in KEEP_FORMATS else 'PNG'
+        )
+        icc_profile = image.info.get('icc_profile')
+        # поворот из EXIF применяем, пока EXIF еще есть
+        image = ImageOps.exif_transpose(image)
+        image.info = {}
+        if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        options = dict(SAVE_OPTIONS.get(image_format, {}))
+        if icc_profile:
+            # цветовой профиль - не метаданные, без него цвета поплывут
+            options['icc_profile'] = icc_profile
+        descriptor, target = tempfile.mkstemp(
+            suffix='.' + KEEP_FORMATS[image_format],
+            dir=os.path.dirname(source_path),
+        )
+        with os.fdopen(descriptor, 'wb') as output:
+            image.save(output, image_format, **options)
+    return target
+
+
+def stage_upload(upload) -> str:
+    '''Копируем загрузку кусками в файл, который переживет запрос.'''
+
+    descriptor, path = tempfile.mkstemp(
+        prefix='ingest_', dir=settings.FILE_UPLOAD_TEMP_DIR
+    )
+    with os.fdopen(descriptor, 'wb') as staged:
+        for chunk in upload.chunks():
+            staged.write(chunk)
+    return path
+
+
+def stage_post_image(form) -> Optional[dict]:
+    '''
+    Снимаем новую загрузку с поста валидной формы PostForm:
+    пост сохранится с прежней картинкой, а загрузка уйдет
+    в ingest_post_image. Возвращаем задание для нее или None.
+    '''
+
+    upload = form.cleaned_data.get('image')
+    if 'image' not in form.changed_data or not upload:
+        return None
+    previous = form.initial.get('image') or ''
+    form.instance.image = previous
+    return {
+        'path': stage_upload(upload),
+        'name': upload.name,
+        'expected': form.instance.image.name or '',
+    }
+
+
+def ingest_post_image(post: Post, job: Optional[dict]) -> None:
+    '''
+    Перекодируем картинку задания job и прикрепляем ее к посту.
+    При IMAGE_INGEST_WORKERS = 0 - сразу, в текущем потоке,
+    иначе в пулах после фиксации транзакции.
+    '''
+
+    if job is None:
+        return
+    if not settings.IMAGE_INGEST_WORKERS:
+        _ingest(post.pk, job, in_process=False)
+        return
+    transaction.on_commit(
+        lambda: get_executor().submit(_ingest_in_worker, post.pk, job)
+    )
+
+
+def _ingest_in_worker(post_pk: int, job: dict) -> None:
+    try:
+        _ingest(post_pk, job, in_process=True)
+    except Exception:
+        logger.exception('Не удалось принять картинку поста %s', post_pk)
+    finally:
+        # соединения с БД у потоков пула свои
+        connections.close_all()
+
+
+def _ingest(post_pk: int, job: dict, in_process: bool) -> None:
+    clean_path = None
+    try:
+        if in_process:
+            clean_path = get_process_pool().submit(
+                reencode_image, job['path'], settings.POST_IMAGE_MAX_PIXELS
+            ).result()
+        else:
+            clean_path = reencode_image(
+                job['path'], settings.POST_IMAGE_MAX_PIXELS
+            )
+        _attach(post_pk, job, clean_path)
+    finally:
+        for path in (job['path'], clean_path):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+
+def _attach(post_pk: int, job: dict, clean_path: str) -> None:
+    post = Post.objects.filter(pk=post_pk).first()
+    # пост удалили или к нему уже прикрепили более новую картинку
+    if post is None or (post.image.name or '') != job['expected']:
+        return
+    stem = os.path.splitext(os.path.basename(job['name']))[0]
+    extension = os.path.splitext(clean_path)[1]
+    with open(clean_path, 'rb') as clean:
+        post.image.save(stem + extension, File(clean), save=False)
+    describe_post_image(post)
+    post.save(update_fields=['image', *IMAGE_METADATA_FIELDS, 'updated'])
+    enqueue_thumbnails(post)
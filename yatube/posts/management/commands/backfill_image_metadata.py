@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from posts.cache import invalidate_posts_pages
+from posts.images import IMAGE_METADATA_FIELDS, describe_post_image
+from posts.models import Post
+
+
+class Command(BaseCommand):
+    help = (
+        'Заполняет размеры и заглушки картинок у постов, '
+        'сохраненных до появления этих полей.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Кол-во постов в одной пачке',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        posts = Post.objects.exclude(image='').filter(
+            image_size__isnull=True
+        ).only('pk', 'image', 'author_id', 'group_id')
+
+        described = missing = 0
+        batch = []
+        for post in posts.iterator(chunk_size=batch_size):
+            describe_post_image(post)
+            if post.image_size is None:
+                missing += 1
+                continue
+            # новое updated меняет и ключи закешированных карточек
+            post.updated = timezone.now()
+            batch.append(post)
+            if len(batch) >= batch_size:
+                described += self.save_batch(batch)
+                batch = []
+        described += self.save_batch(batch)
+        self.stdout.write(
+            f'Заполнено постов: {described}, без картинки: {missing}'
+        )
+
+    def save_batch(self, posts) -> int:
+        # bulk_update, а не save(): сигналы поста (лента, счетчики,
+        # сброс страниц) на каждый пост не нужны, страницы
+        # сбрасываем разом на всю пачку
+        Post.objects.bulk_update(posts, [*IMAGE_METADATA_FIELDS, 'updated'])
+        invalidate_posts_pages(posts)
+        return len(posts)
@@ -0,0 +1,240 @@
+import json
+import os
+import time
+
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from sorl.thumbnail import default
+from sorl.thumbnail.conf import settings as sorl_settings
+from sorl.thumbnail.images import ImageFile, deserialize_image_file
+from sorl.thumbnail.kvstores.base import add_prefix, del_prefix
+from sorl.thumbnail.models import KVStore as KVStoreModel
+
+from core.models import StoredFile
+from core.storage import walk_storage
+from posts.models import Post
+
+# Проходы сборщика по порядку
+PHASES = ('originals', 'sources', 'thumbnails')
+
+
+class LimitReached(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Удаляет картинки постов, на которые не ссылается ни один пост, '
+        'и миниатюры sorl удаленных картинок. Хранилище и БД читаются '
+        'пачками. С --checkpoint и --limit работает по частям: '
+        'следующий запуск продолжает с места остановки.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Кол-во файлов или записей в одной пачке',
+        )
+        parser.add_argument(
+            '--min-age',
+            type=int,
+            default=60 * 60,
+            help='Не трогать файлы моложе стольких секунд',
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='Файл, где хранится место остановки',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=0,
+            help='Остановиться после стольких проверенных объектов',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только посчитать, ничего не удалять',
+        )
+
+    def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        self.dry_run = options['dry_run']
+        self.limit = options['limit']
+        self.checkpoint_path = options['checkpoint']
+        self.created_before = time.time() - options['min_age']
+        self.examined = self.files = self.reclaimed = 0
+
+        checkpoint = self.load_checkpoint()
+        steps = {
+            'originals': self.collect_originals,
+            'sources': self.collect_sources,
+            'thumbnails': self.collect_thumbnails,
+        }
+        try:
+            for phase in PHASES[PHASES.index(checkpoint['phase']):]:
+                after = checkpoint['after'] if (
+                    phase == checkpoint['phase']
+                ) else ''
+                steps[phase](phase, after)
+        except LimitReached:
+            self.stdout.write('Достигнут --limit, продолжите позже')
+        else:
+            self.save_checkpoint(None, None)
+
+        self.stdout.write(
+            f'Удалено файлов: {self.files}, '
+            f'освобождено байт: {self.reclaimed}'
+        )
+
+    def collect_originals(self, phase, after):
+        '''Исходные картинки, на которые не ссылается ни один пост.'''
+
+        storage = Post.image.field.storage
+        names = (
+            name for name in walk_storage(
+                storage, Post.image.field.upload_to
+            ) if name > after
+        )
+        for batch in self.batches(names):
+            referenced = set(Post.objects.filter(
+                image__in=batch
+            ).values_list('image', flat=True))
+            orphans = [
+                name for name in batch
+                if name not in referenced and self.is_old(storage, name)
+            ]
+            for name in orphans:
+                self.remove_original(storage, name)
+            self.advance(phase, batch)
+
+    def remove_original(self, storage, name):
+        '''
+        Удаляем картинку вместе с записью StoredFile в одной транзакции.
+        Удаление записи блокирует ее: параллельная загрузка того же
+        содержимого ждет в add_reference и после нас запишет файл
+        заново. Загрузка, успевшая раньше, уже обновила время изменения
+        файла, поэтому проверки повторяем после блокировки.
+        '''
+
+        if self.dry_run:
+            self.remove(storage, name)
+            return
+        with transaction.atomic():
+            StoredFile.objects.filter(name=name).delete()
+            if Post.objects.filter(image=name).exists() or not (
+                self.is_old(storage, name)
+            ):
+                transaction.set_rollback(True)
+                return
+            self.remove(storage, name)
+
+    def collect_sources(self, phase, after):
+        '''Записи sorl об исходных картинках, которых больше нет.'''
+
+        kvstore = default.kvstore
+        prefix = add_prefix('', 'thumbnails')
+        keys = KVStoreModel.objects.filter(
+            key__startswith=prefix, key__gt=after
+        ).order_by('key').values_list('key', flat=True)
+        for batch in self.batches(keys.iterator(chunk_size=self.batch_size)):
+            images = dict(KVStoreModel.objects.filter(key__in=[
+                add_prefix(del_prefix(key)) for key in batch
+            ]).values_list('key', 'value'))
+            for key in batch:
+                value = images.get(add_prefix(del_prefix(key)))
+                source = value and deserialize_image_file(value)
+                if source and source.exists():
+                    continue
+                for thumbnail_key in kvstore._get(
+                    del_prefix(key), identity='thumbnails'
+                ) or []:
+                    thumbnail = kvstore._get(thumbnail_key)
+                    if thumbnail and thumbnail.exists():
+                        self.remove(thumbnail.storage, thumbnail.name)
+                    if not self.dry_run:
+                        kvstore._delete(thumbnail_key)
+                if not self.dry_run:
+                    if source:
+                        kvstore.delete(source, delete_thumbnails=False)
+                    kvstore._delete(del_prefix(key), identity='thumbnails')
+            self.advance(phase, batch)
+
+    def collect_thumbnails(self, phase, after):
+        '''Файлы миниатюр, о которых sorl ничего не знает.'''
+
+        storage = default.storage
+        names = (
+            name for name in walk_storage(
+                storage, sorl_settings.THUMBNAIL_PREFIX.rstrip('/')
+            ) if name > after
+        )
+        for batch in self.batches(names):
+            keys = {
+                add_prefix(ImageFile(name, storage).key): name
+                for name in batch
+            }
+            known = set(KVStoreModel.objects.filter(
+                key__in=list(keys)
+            ).values_list('key', flat=True))
+            for key, name in keys.items():
+                if key not in known and self.is_old(storage, name):
+                    self.remove(storage, name)
+            self.advance(phase, batch)
+
+    def is_old(self, storage, name):
+        # свежий файл может ждать сохранения поста или записи sorl
+        try:
+            modified = storage.get_modified_time(name)
+        except FileNotFoundError:
+            # уже удален, беречь нечего
+            return True
+        return modified.timestamp() < self.created_before
+
+    def remove(self, storage, name):
+        try:
+            self.reclaimed += storage.size(name)
+        except OSError:
+            return
+        self.files += 1
+        if not self.dry_run:
+            # мимо подсчета ссылок HashedFileSystemStorage
+            FileSystemStorage.delete(storage, name)
+
+    def batches(self, items):
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def advance(self, phase, batch):
+        '''Пачка обработана: сохраняем место и проверяем --limit.'''
+
+        self.examined += len(batch)
+        self.save_checkpoint(phase, batch[-1])
+        if self.limit and self.examined >= self.limit:
+            raise LimitReached
+
+    def load_checkpoint(self):
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as checkpoint:
+                return json.load(checkpoint)
+        return {'phase': PHASES[0], 'after': ''}
+
+    def save_checkpoint(self, phase, after):
+        if not self.checkpoint_path or self.dry_run:
+            return
+        if phase is None:
+            # проход завершен, следующий начнется сначала
+            if os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+            return
+        with open(self.checkpoint_path, 'w') as checkpoint:
+            json.dump({'phase': phase, 'after': after}, checkpoint)
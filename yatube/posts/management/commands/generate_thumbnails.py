@@ -0,0 +1,106 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.core.validators import get_available_image_extensions
+from django.db import connections
+
+from core.storage import walk_storage
+from posts.images import generate_thumbnails
+from posts.models import Post
+
+
+class Command(BaseCommand):
+    help = (
+        'Создает миниатюры для всех картинок постов в несколько потоков. '
+        'Готовые миниатюры пропускаются, поэтому прерванный запуск '
+        'можно просто повторить. Файлы не картинок пропускаются, '
+        'ошибка одной картинки выводится и не прерывает запуск.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='Кол-во потоков; 1 - без пула, в текущем потоке',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Пересоздать уже готовые миниатюры',
+        )
+        parser.add_argument(
+            '--start-after',
+            default='',
+            help='Продолжить с файла, следующего за указанным',
+        )
+
+    def handle(self, *args, **options):
+        force = options['force']
+        # остальное - не картинки: чужие файлы и недописанные
+        # временные файлы хранилища (tmp* без расширения)
+        extensions = {
+            '.' + extension.lower()
+            for extension in get_available_image_extensions()
+        }
+        names = (
+            name for name in walk_storage(
+                Post.image.field.storage, Post.image.field.upload_to
+            )
+            if name > options['start_after']
+            and os.path.splitext(name)[1].lower() in extensions
+        )
+
+        workers = options['workers']
+        self.done = self.failed = 0
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for batch in self.batches(names, workers * 8):
+                    # map отдает результаты по порядку имен, поэтому
+                    # последнее выведенное имя годится для --start-after
+                    for result in pool.map(
+                        lambda name: self.process(name, force), batch
+                    ):
+                        self.report(*result)
+        else:
+            for name in names:
+                self.report(*self.generate(name, force))
+        self.stdout.write(
+            f'Обработано картинок: {self.done}, с ошибкой: {self.failed}'
+        )
+
+    @staticmethod
+    def generate(name, force):
+        try:
+            return name, generate_thumbnails(name, force=force), None
+        except Exception as error:
+            # битый файл: сообщаем и идем дальше
+            return name, False, error
+
+    @classmethod
+    def process(cls, name, force):
+        try:
+            return cls.generate(name, force)
+        finally:
+            # соединения с БД у потоков пула свои
+            connections.close_all()
+
+    def report(self, name, created, error):
+        if error is not None:
+            self.failed += 1
+            self.stderr.write(f'Ошибка: {name}: {error!r}')
+            return
+        self.done += int(created)
+        self.stdout.write(f'Готово: {name}')
+
+    @staticmethod
+    def batches(names, batch_size):
+        batch = []
+        for name in names:
+            batch.append(name)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
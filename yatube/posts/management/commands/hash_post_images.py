@@ -0,0 +1,100 @@
+import os
+
+from django.core.files import File
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from core.storage import content_hash, is_hashed_name
+from posts.cache import invalidate_posts_pages
+from posts.models import Post
+
+
+class Command(BaseCommand):
+    help = (
+        'Переносит картинки постов из плоского каталога posts/ '
+        'на место в хранилище с адресацией по содержимому. Файл '
+        'сначала появляется под новым именем (жесткой ссылкой, без '
+        'копирования), затем все посты переводятся на него одним '
+        'запросом, и только потом прежний файл удаляется, поэтому '
+        'команду можно прервать и повторить. Одинаковые картинки '
+        'остаются в одном экземпляре. Миниатюры новых имен создает '
+        'команда generate_thumbnails.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Кол-во прежних имен в одной пачке',
+        )
+
+    def handle(self, *args, **options):
+        storage = Post.image.field.storage
+        names = Post.objects.exclude(image='').order_by('image').values_list(
+            'image', flat=True
+        ).distinct()
+
+        done = files = missing = 0
+        after = ''
+        while True:
+            # имена перебираем по возрастанию, а не курсором: строки
+            # меняются по ходу прохода
+            batch = list(names.filter(image__gt=after)[
+                :options['batch_size']
+            ])
+            if not batch:
+                break
+            after = batch[-1]
+            for name in batch:
+                if is_hashed_name(name):
+                    continue
+                if not storage.exists(name):
+                    missing += Post.objects.filter(image=name).count()
+                    continue
+                done += self.move(storage, name)
+                files += 1
+        self.stdout.write(
+            f'Перенесено постов: {done}, файлов: {files}, '
+            f'без файла: {missing}'
+        )
+
+    @staticmethod
+    def move(storage, name) -> int:
+        '''
+        Переносим одну картинку, возвращаем кол-во ее постов.
+        Прерванный перенос оставляет либо посты на прежнем имени
+        при целом файле, либо лишний прежний файл для сборщика мусора.
+        '''
+
+        with storage.open(name) as source:
+            digest = content_hash(File(source))
+        new_name = storage.hashed_name(name, digest)
+        if not storage.touch(new_name):
+            os.makedirs(
+                os.path.dirname(storage.path(new_name)), exist_ok=True
+            )
+            try:
+                os.link(storage.path(name), storage.path(new_name))
+            except FileExistsError:
+                # такую картинку только что загрузили
+                pass
+            # у жесткой ссылки время изменения прежнего файла,
+            # свежее не даст сборщику мусора удалить ее до update()
+            storage.touch(new_name)
+
+        with transaction.atomic():
+            posts = list(Post.objects.filter(image=name).only(
+                'pk', 'author_id', 'group_id'
+            ))
+            # update(), а не save() на каждый пост: один запрос, и все
+            # посты картинки переходят на новое имя разом; новое
+            # updated меняет ключи закешированных карточек
+            Post.objects.filter(image=name).update(
+                image=new_name, updated=timezone.now()
+            )
+            storage.add_reference(new_name, len(posts))
+        invalidate_posts_pages(posts)
+        os.remove(storage.path(name))
+        return len(posts)
@@ -0,0 +1,46 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from posts.counters import recount_groups, recount_posts, recount_users
+from posts.models import Group, Post
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересчитывает счетчики постов, комментариев и подписок '
+        'пачками, не загружая все записи в память.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Кол-во записей в одной пачке',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        targets = (
+            ('пользователей', get_user_model().objects, recount_users),
+            ('групп', Group.objects, recount_groups),
+            ('постов', Post.objects, recount_posts),
+        )
+        for title, manager, recount in targets:
+            total = 0
+            for batch in self.batches(manager, batch_size):
+                recount(batch)
+                total += len(batch)
+            self.stdout.write(f'Пересчитаны счетчики {title}: {total}')
+
+    @staticmethod
+    def batches(manager, batch_size):
+        pks = manager.order_by('pk').values_list('pk', flat=True)
+        batch = []
+        for pk in pks.iterator(chunk_size=batch_size):
+            batch.append(pk)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.16 on 2026-10-18 16:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0008_auto_20220627_2236'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='post',
+            options={'ordering': ['-pub_date', '-id']},
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['-pub_date', '-id'], name='post_pub_date_id_idx'),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 2.2.16 on 2026-10-18 16:49
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_counters(apps, schema_editor):
+    '''Считаем счетчики по уже существующим записям.'''
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    Group = apps.get_model('posts', 'Group')
+    Post = apps.get_model('posts', 'Post')
+    Comment = apps.get_model('posts', 'Comment')
+    Follow = apps.get_model('posts', 'Follow')
+    UserCounters = apps.get_model('posts', 'UserCounters')
+
+    def totals(model, field):
+        return dict(
+            model.objects.order_by().values_list(field).annotate(
+                total=models.Count('pk')
+            )
+        )
+
+    posts = totals(Post, 'author')
+    followers = totals(Follow, 'author')
+    following = totals(Follow, 'user')
+    UserCounters.objects.bulk_create(
+        [
+            UserCounters(
+                user_id=pk,
+                posts_count=posts.get(pk, 0),
+                followers_count=followers.get(pk, 0),
+                following_count=following.get(pk, 0),
+            )
+            for pk in User.objects.values_list('pk', flat=True).iterator()
+        ],
+        batch_size=500,
+    )
+    for pk, total in totals(Post, 'group').items():
+        Group.objects.filter(pk=pk).update(posts_count=total)
+    for pk, total in totals(Comment, 'post').items():
+        Post.objects.filter(pk=pk).update(comments_count=total)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0011_update_proxy_permissions'),
+        ('posts', '0010_auto_20261018_1646'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserCounters',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='counters', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+                ('posts_count', models.PositiveIntegerField(default=0, verbose_name='Кол-во постов')),
+                ('followers_count', models.PositiveIntegerField(default=0, verbose_name='Кол-во подписчиков')),
+                ('following_count', models.PositiveIntegerField(default=0, verbose_name='Кол-во подписок')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='posts_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Кол-во постов'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='comments_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Кол-во комментариев'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.16 on 2026-10-18 17:02
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def set_updated(apps, schema_editor):
+    Post = apps.get_model('posts', 'Post')
+    Post.objects.update(updated=models.F('pub_date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0011_auto_20261018_1649'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='Дата изменения'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(set_updated, migrations.RunPython.noop),
+    ]
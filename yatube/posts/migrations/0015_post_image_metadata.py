@@ -0,0 +1,33 @@
+# Generated by Django 2.2.16 on 2026-10-18 16:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0014_post_image_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='image_height',
+            field=models.PositiveIntegerField(editable=False, null=True, verbose_name='Высота картинки'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='image_placeholder',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='Заглушка картинки'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='image_size',
+            field=models.PositiveIntegerField(editable=False, null=True, verbose_name='Размер картинки, байт'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='image_width',
+            field=models.PositiveIntegerField(editable=False, null=True, verbose_name='Ширина картинки'),
+        ),
+    ]
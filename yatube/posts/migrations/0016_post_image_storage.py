@@ -0,0 +1,19 @@
+# Generated by Django 2.2.16 on 2026-10-18 17:04
+
+import core.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0015_post_image_metadata'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='post',
+            name='image',
+            field=models.ImageField(blank=True, help_text='Изображение, которое будет выводится над постом', storage=core.storage.HashedFileSystemStorage(), upload_to='posts/', verbose_name='Картинка'),
+        ),
+    ]
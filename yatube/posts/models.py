@@ -1,9 +1,34 @@
+import json
+
 from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
 from django.db import models
+from django.utils.functional import cached_property
+
+from core.storage import post_image_storage
 
 User = get_user_model()
 
 
+def _without_counters(instance, counters, update_fields):
+    '''
+    update_fields для сохранения уже существующей строки без счетчиков:
+    их значение, прочитанное вместе с объектом, затерло бы сдвиги F()
+    из posts.counters, сделанные после чтения. Счетчики меняются
+    только через update() и bulk_update().
+    '''
+
+    if instance._state.adding:
+        return update_fields
+    if update_fields is None:
+        deferred = instance.get_deferred_fields()
+        update_fields = [
+            field.name for field in instance._meta.concrete_fields
+            if not field.primary_key and field.attname not in deferred
+        ]
+    return [name for name in update_fields if name not in counters]
+
+
 class Group(models.Model):
     '''
     Класс представляет собой группу публикаций.
@@ -14,7 +39,9 @@ class Group(models.Model):
     slug : str
         аббревиатура, используемая в url;
     description : str
-        описание группы.
+        описание группы;
+    posts_count : int
+        кол-во постов в группе (счетчик).
     '''
 
     title = models.CharField(
@@ -31,10 +58,47 @@ class Group(models.Model):
     description = models.TextField(
         verbose_name="Описание",
     )
+    posts_count = models.PositiveIntegerField(
+        verbose_name="Кол-во постов",
+        default=0,
+        editable=False,
+    )
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, update_fields=None, **kwargs):
+        super().save(*args, update_fields=_without_counters(
+            self, ('posts_count',), update_fields
+        ), **kwargs)
+
+
+class PostQuerySet(models.QuerySet):
+    '''
+    Выборки постов, подогнанные под шаблоны: все, что шаблон
+    читает у поста, достается одним запросом.
+    '''
+
+    # posts/includes/post_info.html
+    FEED_RELATED = ('author', 'group')
+    FEED_FIELDS = (
+        'text', 'pub_date', 'updated', 'image', 'image_variants',
+        'image_width', 'image_height', 'image_placeholder',
+        'author_id', 'group_id',
+        'author__username', 'author__first_name', 'author__last_name',
+        'group__title', 'group__slug',
+    )
+    # posts/post_detail.html
+    DETAIL_RELATED = ('author', 'group')
+
+    def for_feed(self):
+        return self.select_related(*self.FEED_RELATED).only(
+            *self.FEED_FIELDS
+        )
+
+    def for_detail(self):
+        return self.select_related(*self.DETAIL_RELATED)
+
 
 class Post(models.Model):
     '''
@@ -45,10 +109,20 @@ class Post(models.Model):
         текст публикации
     pub_date : datetime
         дата публикации
+    updated : datetime
+        дата последнего изменения, версия поста для кешей
     author : User
         автор
     группа : Group
-        группа, в которой была выложена публикация.
+        группа, в которой была выложена публикация
+    comments_count : int
+        кол-во комментариев (счетчик).
+    image_variants : str
+        манифест уменьшенных копий картинки, см. posts.images
+    image_width, image_height, image_size : int
+        размеры исходной картинки в пикселях и байтах
+    image_placeholder : str
+        крошечная копия картинки (data URI) для ленивой загрузки
     '''
 
     text = models.TextField(
@@ -59,6 +133,10 @@ class Post(models.Model):
         auto_now_add=True,
         verbose_name="Дата"
     )
+    updated = models.DateTimeField(
+        auto_now=True,
+        verbose_name="Дата изменения"
+    )
     author = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
@@ -77,16 +155,114 @@ class Post(models.Model):
     image = models.ImageField(
         'Картинка',
         upload_to='posts/',
+        storage=post_image_storage,
         blank=True,
         help_text="Изображение, которое будет выводится над постом"
     )
+    image_variants = models.TextField(
+        verbose_name="Варианты картинки",
+        blank=True,
+        default='',
+        editable=False,
+    )
+    image_width = models.PositiveIntegerField(
+        verbose_name="Ширина картинки",
+        null=True,
+        editable=False,
+    )
+    image_height = models.PositiveIntegerField(
+        verbose_name="Высота картинки",
+        null=True,
+        editable=False,
+    )
+    image_size = models.PositiveIntegerField(
+        verbose_name="Размер картинки, байт",
+        null=True,
+        editable=False,
+    )
+    image_placeholder = models.TextField(
+        verbose_name="Заглушка картинки",
+        blank=True,
+        default='',
+        editable=False,
+    )
+    comments_count = models.PositiveIntegerField(
+        verbose_name="Кол-во комментариев",
+        default=0,
+        editable=False,
+    )
+
+    objects = PostQuerySet.as_manager()
 
     class Meta:
-        ordering = ['-pub_date']
+        ordering = ['-pub_date', '-id']
+        indexes = [
+            # ключ курсорной пагинации
+            models.Index(
+                fields=['-pub_date', '-id'],
+                name='post_pub_date_id_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.text[:15]
 
+    def save(self, *args, update_fields=None, **kwargs):
+        super().save(*args, update_fields=_without_counters(
+            self, ('comments_count',), update_fields
+        ), **kwargs)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # запоминаем группу, чтобы при ее смене поправить счетчики
+        if 'group_id' in instance.__dict__:
+            instance._counted_group_id = instance.group_id
+        # и картинку, чтобы при ее замене убрать ссылку на прежнюю
+        if 'image' in instance.__dict__:
+            instance._stored_image = instance.image.name or ''
+        return instance
+
+    @cached_property
+    def image_sources(self):
+        '''
+        src, srcset и размеры картинки для шаблона из манифеста
+        image_variants, без обращения к файлам. None, если манифеста
+        нет или он собран для прежней картинки.
+        '''
+
+        if not self.image or not self.image_variants:
+            return None
+        manifest = json.loads(self.image_variants)
+        if manifest['n'] != self.image.name:
+            return None
+        # [ширина, высота, JPEG, WebP или '']
+        variants = manifest['v']
+        width, height, largest, _ = variants[-1]
+        return {
+            'src': default_storage.url(largest),
+            'width': width,
+            'height': height,
+            'srcset': ', '.join(
+                f'{default_storage.url(jpeg)} {w}w'
+                for w, _, jpeg, _ in variants
+            ),
+            'webp_srcset': ', '.join(
+                f'{default_storage.url(webp)} {w}w'
+                for w, _, _, webp in variants if webp
+            ),
+        }
+
+
+class CommentQuerySet(models.QuerySet):
+    '''Выборки комментариев под шаблоны.'''
+
+    # posts/includes/comments.html
+    LIST_RELATED = ('author',)
+
+    def for_list(self):
+        return self.select_related(*self.LIST_RELATED)
+
 
 class Comment(models.Model):
     '''
@@ -123,6 +299,8 @@ class Comment(models.Model):
         verbose_name="Дата"
     )
 
+    objects = CommentQuerySet.as_manager()
+
     class Meta:
         ordering = ['-created']
 
@@ -151,3 +329,88 @@ class Follow(models.Model):
                 name='follow_user_author_unique_relationships'
             ),
         ]
+
+
+class TimelineEntry(models.Model):
+    '''
+    Запись ленты подписок пользователя (fan-out on write).
+    Атрибуты:
+    ----------
+    user : User
+        владелец ленты
+    post : Post
+        пост автора, на которого подписан пользователь
+    pub_date : datetime
+        дата публикации поста, копия Post.pub_date для сортировки
+    '''
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='timeline',
+        verbose_name="Владелец ленты",
+    )
+    post = models.ForeignKey(
+        Post,
+        on_delete=models.CASCADE,
+        related_name='timeline_entries',
+        verbose_name="Пост",
+    )
+    pub_date = models.DateTimeField(
+        verbose_name="Дата публикации",
+    )
+
+    class Meta:
+        ordering = ['-pub_date', '-post']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'post'],
+                name='timeline_user_post_unique'
+            ),
+        ]
+        indexes = [
+            models.Index(
+                fields=['user', '-pub_date', '-post'],
+                name='timeline_user_pub_date_idx'
+            ),
+        ]
+
+    def __str__(self):
+        return '{} <- {}'.format(self.user_id, self.post_id)
+
+
+class UserCounters(models.Model):
+    '''
+    Счетчики пользователя, поддерживаются сигналами.
+    Атрибуты:
+    ----------
+    user : User
+        пользователь
+    posts_count : int
+        кол-во постов автора
+    followers_count : int
+        кол-во подписчиков
+    following_count : int
+        кол-во подписок
+    '''
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='counters',
+        verbose_name="Пользователь",
+    )
+    posts_count = models.PositiveIntegerField(
+        verbose_name="Кол-во постов",
+        default=0,
+    )
+    followers_count = models.PositiveIntegerField(
+        verbose_name="Кол-во подписчиков",
+        default=0,
+    )
+    following_count = models.PositiveIntegerField(
+        verbose_name="Кол-во подписок",
+        default=0,
+    )
+
+    def __str__(self):
+        return str(self.user_id)
@@ -0,0 +1,204 @@
+'''
+Полнотекстовый поиск по постам на SQLite FTS5.
+
+Индекс posts_post_fts хранит только ссылки на posts_post
+(external content) и поддерживается триггерами, поэтому
+bulk_create и update() тоже попадают в индекс. SQLite при
+изменении схемы пересоздает таблицу posts_post вместе с ее
+триггерами, поэтому после каждого migrate триггеры
+восстанавливаются (см. PostsConfig.ready).
+'''
+import re
+from typing import List, Optional, Tuple
+
+from django.db import connection
+from django.db.models import QuerySet
+
+from .models import Post
+from .utils import InvalidCursor, decode_cursor, encode_cursor
+
+FTS_TABLE = 'posts_post_fts'
+
+FTS_SCHEMA = (
+    f'''CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        text, content='posts_post', content_rowid='id'
+    )''',
+    f'''CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai
+    AFTER INSERT ON posts_post BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, text) VALUES (new.id, new.text);
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad
+    AFTER DELETE ON posts_post BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text)
+        VALUES ('delete', old.id, old.text);
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au
+    AFTER UPDATE OF text ON posts_post BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text)
+        VALUES ('delete', old.id, old.text);
+        INSERT INTO {FTS_TABLE}(rowid, text) VALUES (new.id, new.text);
+    END''',
+)
+
+FTS_TRIGGERS = (f'{FTS_TABLE}_ai', f'{FTS_TABLE}_ad', f'{FTS_TABLE}_au')
+
+CURSOR_SEARCH = 's'
+
+
+def search_available(using=connection) -> bool:
+    return using.vendor == 'sqlite'
+
+
+def ensure_search_index(using=connection) -> None:
+    '''
+    Создаем индекс и триггеры, если их нет. Если триггеры
+    пропали вместе с пересозданной таблицей, индекс перестраиваем.
+    '''
+
+    if not search_available(using):
+        return
+    if Post._meta.db_table not in using.introspection.table_names():
+        return
+    with using.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' "
+            "AND tbl_name = 'posts_post'"
+        )
+        triggers = {row[0] for row in cursor.fetchall()}
+        for statement in FTS_SCHEMA:
+            cursor.execute(statement)
+        if not triggers.issuperset(FTS_TRIGGERS):
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"
+            )
+
+
+def drop_search_index(using=connection) -> None:
+    if not search_available(using):
+        return
+    with using.cursor() as cursor:
+        for trigger in FTS_TRIGGERS:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+def build_match(query: str) -> str:
+    '''
+    Превращаем пользовательский ввод в запрос FTS5:
+    каждое слово в кавычках, все слова обязательны.
+    '''
+
+    return ' '.join(f'"{word}"' for word in re.findall(r'\w+', query))
+
+
+def match_posts(queryset: QuerySet, query: str) -> QuerySet:
+    '''Фильтр queryset по полнотекстовому индексу, без ранжирования.'''
+
+    match = build_match(query)
+    if not match:
+        return queryset.none()
+    if not search_available():
+        return queryset.filter(text__icontains=query)
+    # RawSQL в pk__in SQLite понимает как скалярный подзапрос
+    # (IN ((SELECT ...))) и берет только первую строку
+    return queryset.extra(
+        where=[
+            f'{Post._meta.db_table}.id IN (SELECT rowid FROM {FTS_TABLE} '
+            f'WHERE {FTS_TABLE} MATCH %s)'
+        ],
+        params=[match],
+    )
+
+
+def search_posts(
+    query: str,
+    group_id: int = None,
+    author_id: int = None,
+    cursor: str = None,
+    limit: int = 10,
+) -> Tuple[List[Post], Optional[str]]:
+    '''
+    Ищем посты по тексту, лучшие совпадения (bm25) первыми.
+    Возвращаем посты страницы и курсор следующей страницы.
+    '''
+
+    match = build_match(query)
+    if not match:
+        return [], None
+
+    try:
+        position = _parse_cursor(cursor) if cursor else None
+    except InvalidCursor:
+        # как и CursorPaginator, начинаем с первой страницы
+        position = None
+
+    if not search_available():
+        return _search_posts_fallback(
+            query, group_id, author_id, position, limit
+        )
+
+    filters, params = [], [match]
+    if group_id is not None:
+        filters.append('p.group_id = %s')
+        params.append(group_id)
+    if author_id is not None:
+        filters.append('p.author_id = %s')
+        params.append(author_id)
+    where = ''.join(f' AND {condition}' for condition in filters)
+
+    after = ''
+    if position:
+        rank, pk = position
+        after = 'WHERE rank > %s OR (rank = %s AND id > %s)'
+        params.extend([rank, rank, pk])
+    params.append(limit + 1)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT id, rank FROM ('
+            f'SELECT p.id AS id, bm25({FTS_TABLE}) AS rank '
+            f'FROM {FTS_TABLE} '
+            f'JOIN posts_post p ON p.id = {FTS_TABLE}.rowid '
+            f'WHERE {FTS_TABLE} MATCH %s{where}'
+            f') {after} ORDER BY rank, id LIMIT %s',
+            params
+        )
+        rows = cursor.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(CURSOR_SEARCH, repr(rows[-1][1]),
+                                    rows[-1][0])
+
+    posts = Post.objects.for_feed().in_bulk([pk for pk, _ in rows])
+    return [posts[pk] for pk, _ in rows if pk in posts], next_cursor
+
+
+def _parse_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        direction, rank, pk = decode_cursor(cursor)
+        if direction != CURSOR_SEARCH:
+            raise ValueError
+        return float(rank), int(pk)
+    except (ValueError, InvalidCursor):
+        raise InvalidCursor('Некорректный курсор')
+
+
+def _search_posts_fallback(query, group_id, author_id, position, limit):
+    '''Поиск без FTS5 (не SQLite): LIKE и сортировка по новизне.'''
+
+    posts = Post.objects.for_feed().filter(text__icontains=query)
+    if group_id is not None:
+        posts = posts.filter(group_id=group_id)
+    if author_id is not None:
+        posts = posts.filter(author_id=author_id)
+    if position:
+        posts = posts.filter(pk__lt=position[1])
+    posts = list(posts.order_by('-pk')[:limit + 1])
+
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        next_cursor = encode_cursor(CURSOR_SEARCH, 0, posts[-1].pk)
+    return posts, next_cursor
@@ -0,0 +1,203 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import (post_delete, post_save, pre_delete,
+                                      pre_save)
+from django.dispatch import receiver
+
+from . import counters
+from .cache import (invalidate_author_cards, invalidate_author_pages,
+                    invalidate_follow_page, invalidate_followers_pages,
+                    invalidate_group_cards, invalidate_group_page,
+                    invalidate_group_pages, invalidate_group_posts_pages,
+                    invalidate_index,
+                    invalidate_post_pages, invalidate_posts_count,
+                    invalidate_profile_pages)
+from .images import describe_post_image
+from .models import Comment, Follow, Group, Post, UserCounters
+from .timeline import backfill_timeline, fan_out_post, prune_timeline
+
+User = get_user_model()
+
+
+@receiver(pre_save, sender=Post)
+def post_image_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # новая загрузка еще в памяти: меряем ее, пока не записали
+    uploaded = instance.image and not instance.image._committed
+    if uploaded or (not instance.image and instance.image_size):
+        describe_post_image(instance)
+
+
+@receiver(post_save, sender=Post)
+def post_image_stored(sender, instance, created, raw=False, **kwargs):
+    # ссылка на прежнюю картинку в хранилище больше не нужна
+    previous = getattr(instance, '_stored_image', '')
+    current = instance.image.name or ''
+    if previous and previous != current and not raw:
+        instance.image.storage.delete(previous)
+    instance._stored_image = current
+
+
+@receiver(post_delete, sender=Post)
+def post_image_released(sender, instance, **kwargs):
+    if instance.image:
+        instance.image.storage.delete(instance.image.name)
+
+
+@receiver(post_save, sender=Post)
+def post_created(sender, instance, created, **kwargs):
+    if created:
+        fan_out_post(instance)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def post_count_changed(sender, **kwargs):
+    invalidate_posts_count()
+
+
+@receiver(post_save, sender=User)
+def user_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        UserCounters.objects.get_or_create(user=instance)
+
+
+@receiver(post_save, sender=Post)
+def post_counters_saved(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        counters.post_saved(instance, created)
+
+
+@receiver(post_delete, sender=Post)
+def post_counters_deleted(sender, instance, **kwargs):
+    counters.post_deleted(instance)
+
+
+@receiver(post_save, sender=Comment)
+def comment_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        counters.comment_changed(instance, 1)
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance, **kwargs):
+    counters.comment_changed(instance, -1)
+
+
+@receiver(post_save, sender=Follow)
+def follow_counters_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        counters.follow_changed(instance, 1)
+
+
+@receiver(post_delete, sender=Follow)
+def follow_counters_deleted(sender, instance, **kwargs):
+    counters.follow_changed(instance, -1)
+
+
+@receiver(post_save, sender=Follow)
+def follow_created(sender, instance, created, **kwargs):
+    if created:
+        backfill_timeline(instance.user_id, instance.author_id)
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(sender, instance, **kwargs):
+    prune_timeline(instance.user_id, instance.author_id)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def index_changed(sender, update_fields=None, **kwargs):
+    # вход пользователя обновляет только last_login
+    if update_fields and set(update_fields) == {'last_login'}:
+        return
+    invalidate_index()
+
+
+@receiver(post_save, sender=Follow)
+@receiver(post_delete, sender=Follow)
+def follow_page_changed(sender, instance, **kwargs):
+    invalidate_follow_page(instance.user_id)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def followers_pages_changed(sender, instance, **kwargs):
+    invalidate_followers_pages(instance.author_id)
+
+
+@receiver(pre_save, sender=Post)
+def post_group_changed(sender, instance, raw=False, **kwargs):
+    # после сохранения прежнюю группу уже не узнать
+    previous = getattr(instance, '_counted_group_id', None)
+    if previous and previous != instance.group_id and not raw:
+        invalidate_group_pages([previous])
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def post_pages_changed(sender, instance, **kwargs):
+    # кол-во постов автора на страницах его постов - дыра каркаса,
+    # см. posts.holes, их сбрасывать не нужно
+    invalidate_post_pages([instance.pk])
+    invalidate_group_pages([instance.group_id])
+    invalidate_profile_pages([instance.author_id])
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def comment_pages_changed(sender, instance, **kwargs):
+    invalidate_post_pages([instance.post_id])
+
+
+@receiver(pre_save, sender=Group)
+def group_renamed(sender, instance, raw=False, **kwargs):
+    if not instance.pk or raw:
+        return
+    # страница под прежним адресом
+    invalidate_group_pages([instance.pk])
+    previous = Group.objects.filter(pk=instance.pk).values(
+        'slug', 'title'
+    ).first()
+    if previous and (previous['slug'], previous['title']) != (
+        instance.slug, instance.title
+    ):
+        invalidate_group_posts_pages(instance.pk)
+
+
+@receiver(pre_delete, sender=Group)
+def group_deleted(sender, instance, **kwargs):
+    # SET_NULL обнуляет группу постов без их сигналов
+    invalidate_group_posts_pages(instance.pk)
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def group_pages_changed(sender, instance, **kwargs):
+    invalidate_group_page(instance.slug)
+    invalidate_group_cards(instance.pk)
+
+
+@receiver(pre_save, sender=User)
+def user_renamed(sender, instance, raw=False, update_fields=None, **kwargs):
+    renamed = not update_fields or 'username' in update_fields
+    if instance.pk and renamed and not raw:
+        # страница под прежним именем
+        invalidate_profile_pages([instance.pk])
+
+
+@receiver(post_save, sender=User)
+def author_pages_changed(sender, instance, update_fields=None, **kwargs):
+    # вход пользователя обновляет только last_login
+    if update_fields and set(update_fields) == {'last_login'}:
+        return
+    invalidate_profile_pages([instance.pk])
+    invalidate_author_pages(instance.pk)
+    invalidate_author_cards(instance.pk)
+    # карточки его постов есть и в лентах подписчиков
+    invalidate_followers_pages(instance.pk)
@@ -1,13 +1,23 @@
+import os
 import shutil
 import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db.models.signals import post_save
 from django.test import Client, TestCase, override_settings
 from django.urls import reverse
+from PIL import Image
 
+from core.models import StoredFile
+from core.storage import is_hashed_name
 from test_utils import get_test_image
 
+from ..images import POST_IMAGE_WIDTHS, generate_thumbnails
 from ..models import Group, Post
 
 User = get_user_model()
@@ -16,7 +26,10 @@ User = get_user_model()
 TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
 
 
-@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+# картинки и миниатюры обрабатываются сразу, в потоке теста
+@override_settings(
+    MEDIA_ROOT=TEMP_MEDIA_ROOT, IMAGE_INGEST_WORKERS=0, THUMBNAIL_WORKERS=0
+)
 class PostCreateFormTests(TestCase):
 
     @classmethod
@@ -94,6 +107,12 @@ class PostCreateFormTests(TestCase):
             post.image.name,
             'Синьор, с картиночкой что-то не так!'
         )
+        # размеры и заглушка картинки посчитаны при сохранении
+        self.assertEqual((post.image_width, post.image_height), (2, 1))
+        self.assertEqual(post.image_size, post.image.size)
+        self.assertTrue(
+            post.image_placeholder.startswith('data:image/png;base64,')
+        )
 
     def test_edit_post(self):
         """Валидная форма изменяет запись в Post."""
@@ -195,3 +214,313 @@ class PostCreateFormTests(TestCase):
             comments_count,
             'Количество комментариев увеличилось'
         )
+
+    def test_generate_thumbnails_command(self):
+        '''Команда создает миниатюры и варианты картинок постов.'''
+        post = Post.objects.create(
+            text='Пост с картинкой',
+            author=self.user,
+            image=get_test_image(),
+        )
+        thumbnails_dir = os.path.join(TEMP_MEDIA_ROOT, 'cache')
+        url = reverse('posts:post_detail', kwargs={'post_id': post.pk})
+        self.guest_client.get(url)
+        saved = []
+
+        def post_saved(sender, instance, **kwargs):
+            saved.append(instance)
+
+        out = StringIO()
+        post_save.connect(post_saved, sender=Post)
+        try:
+            call_command('generate_thumbnails', workers=1, stdout=out)
+        finally:
+            post_save.disconnect(post_saved, sender=Post)
+
+        self.assertIn(post.image.name, out.getvalue())
+        # манифест пишется без сигналов на каждый пост
+        self.assertEqual(saved, [])
+        post.refresh_from_db()
+        sources = post.image_sources
+        self.assertEqual(
+            len(sources['srcset'].split(', ')),
+            len(POST_IMAGE_WIDTHS)
+        )
+        self.assertEqual(sources['width'], POST_IMAGE_WIDTHS[-1])
+        # пропорции исходной картинки 2x1 сохраняются
+        self.assertEqual(sources['height'], POST_IMAGE_WIDTHS[-1] // 2)
+        created = sum(len(files) for _, _, files in os.walk(thumbnails_dir))
+
+        # повторный запуск берет готовые миниатюры
+        call_command(
+            'generate_thumbnails', workers=1, stdout=StringIO()
+        )
+        self.assertEqual(
+            sum(len(files) for _, _, files in os.walk(thumbnails_dir)),
+            created
+        )
+
+        # шаблон строит srcset по манифесту, закешированная
+        # страница сброшена
+        response = self.guest_client.get(url)
+        self.assertContains(response, sources['srcset'])
+        # размеры тега - по сохраненным размерам картинки
+        self.assertContains(response, 'width="960" height="480"')
+
+    def test_generate_thumbnails_command_skips_bad_files(self):
+        '''Чужие и битые файлы не прерывают создание миниатюр.'''
+        post = Post.objects.create(
+            text='Пост с картинкой',
+            author=self.user,
+            image=get_test_image(),
+        )
+        legacy_dir = os.path.join(TEMP_MEDIA_ROOT, 'posts')
+        for name in ('notes.txt', 'broken.gif', 'tmpabc123'):
+            with open(os.path.join(legacy_dir, name), 'w') as file:
+                file.write('не картинка')
+
+        out, err = StringIO(), StringIO()
+        call_command(
+            'generate_thumbnails', workers=1, stdout=out, stderr=err
+        )
+
+        self.assertIn(post.image.name, out.getvalue())
+        self.assertIn('с ошибкой: 1', out.getvalue())
+        self.assertIn('posts/broken.gif', err.getvalue())
+        self.assertNotIn('notes.txt', out.getvalue())
+        self.assertNotIn('tmpabc123', out.getvalue())
+
+    def test_backfill_image_metadata_command(self):
+        '''Команда заполняет размеры картинок старых постов.'''
+        post = Post.objects.create(
+            text='Старый пост с картинкой',
+            author=self.user,
+            image=get_test_image(),
+        )
+        Post.objects.filter(pk=post.pk).update(
+            image_width=None,
+            image_height=None,
+            image_size=None,
+            image_placeholder='',
+        )
+        url = reverse('posts:post_detail', kwargs={'post_id': post.pk})
+        self.assertNotContains(self.guest_client.get(url), 'height="480"')
+
+        saved = []
+
+        def post_saved(sender, instance, **kwargs):
+            saved.append(instance)
+
+        post_save.connect(post_saved, sender=Post)
+        try:
+            call_command('backfill_image_metadata', stdout=StringIO())
+        finally:
+            post_save.disconnect(post_saved, sender=Post)
+
+        # сигналы на каждый пост не срабатывают,
+        # а закешированная страница сбрасывается
+        self.assertEqual(saved, [])
+        post.refresh_from_db()
+        self.assertEqual((post.image_width, post.image_height), (2, 1))
+        self.assertTrue(post.image_placeholder)
+        self.assertContains(self.guest_client.get(url), 'height="480"')
+
+    def test_uploaded_image_is_reencoded(self):
+        '''Загруженная картинка перекодируется без метаданных.'''
+        exif = Image.Exif()
+        exif[0x010F] = 'Камера'
+        buffer = BytesIO()
+        Image.new('RGB', (40, 20), 'red').save(buffer, 'JPEG', exif=exif)
+        upload = SimpleUploadedFile(
+            'photo.jpeg', buffer.getvalue(), content_type='image/jpeg'
+        )
+
+        self.authorized_client.post(
+            reverse('posts:post_create'),
+            data={'text': 'Фото с EXIF', 'image': upload},
+        )
+
+        post = Post.objects.get(text='Фото с EXIF')
+        self.assertTrue(post.image.name.endswith('.jpg'))
+        with Image.open(post.image.path) as image:
+            self.assertEqual(image.size, (40, 20))
+            self.assertNotIn('exif', image.info)
+
+    @override_settings(POST_IMAGE_MAX_PIXELS=1)
+    def test_image_pixel_budget(self):
+        '''Картинка сверх бюджета пикселей не принимается.'''
+        response = self.authorized_client.post(
+            reverse('posts:post_create'),
+            data={'text': 'Слишком большая', 'image': get_test_image()},
+        )
+        self.assertFormError(
+            response, 'form', 'image',
+            'Картинка слишком большая: 2x1 пикселей'
+        )
+        self.assertFalse(Post.objects.filter(text='Слишком большая'))
+
+    def test_identical_images_stored_once(self):
+        '''Одинаковые картинки хранятся одним файлом со счетчиком ссылок.'''
+        first, second = [
+            Post.objects.create(
+                text=f'Одинаковая картинка {i}',
+                author=self.user,
+                image=get_test_image(),
+            )
+            for i in range(2)
+        ]
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertTrue(is_hashed_name(first.image.name))
+        name = first.image.name
+        self.assertEqual(StoredFile.objects.get(name=name).refs, 2)
+
+        first.delete()
+        self.assertTrue(first.image.storage.exists(name))
+        second.delete()
+        self.assertFalse(first.image.storage.exists(name))
+        self.assertFalse(StoredFile.objects.filter(name=name))
+
+    def test_hash_post_images_command(self):
+        '''Команда переносит картинки из плоского каталога.'''
+        legacy_dir = os.path.join(TEMP_MEDIA_ROOT, 'posts')
+        os.makedirs(legacy_dir, exist_ok=True)
+        with open(os.path.join(legacy_dir, 'legacy.gif'), 'wb') as legacy:
+            legacy.write(get_test_image().read())
+        posts = [
+            Post.objects.create(
+                text=f'Старая картинка {i}',
+                author=self.user,
+                image='posts/legacy.gif',
+            )
+            for i in range(2)
+        ]
+
+        call_command('hash_post_images', stdout=StringIO())
+
+        names = {
+            post.image.name
+            for post in Post.objects.filter(pk__in=[p.pk for p in posts])
+        }
+        self.assertEqual(len(names), 1)
+        name = names.pop()
+        self.assertTrue(is_hashed_name(name))
+        self.assertFalse(
+            os.path.exists(os.path.join(legacy_dir, 'legacy.gif'))
+        )
+        self.assertEqual(StoredFile.objects.get(name=name).refs, 2)
+
+    def test_hash_post_images_command_resumes(self):
+        '''Прерванный перенос не теряет картинок и ссылок.'''
+        legacy_dir = os.path.join(TEMP_MEDIA_ROOT, 'posts')
+        os.makedirs(legacy_dir, exist_ok=True)
+        legacy_path = os.path.join(legacy_dir, 'resumed.gif')
+        with open(legacy_path, 'wb') as legacy:
+            legacy.write(get_test_image().read())
+        posts = [
+            Post.objects.create(
+                text=f'Старая картинка {i}',
+                author=self.user,
+                image='posts/resumed.gif',
+            )
+            for i in range(2)
+        ]
+
+        # прерываем команду перед удалением прежнего файла
+        with mock.patch(
+            'posts.management.commands.hash_post_images.os.remove',
+            side_effect=KeyboardInterrupt,
+        ):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('hash_post_images', stdout=StringIO())
+        out = StringIO()
+        call_command('hash_post_images', stdout=out)
+
+        names = {
+            post.image.name
+            for post in Post.objects.filter(pk__in=[p.pk for p in posts])
+        }
+        self.assertEqual(len(names), 1)
+        name = names.pop()
+        self.assertTrue(is_hashed_name(name))
+        self.assertTrue(os.path.exists(posts[0].image.storage.path(name)))
+        self.assertEqual(StoredFile.objects.get(name=name).refs, 2)
+        self.assertIn('без файла: 0', out.getvalue())
+
+    def test_collect_media_garbage_command(self):
+        '''Сборщик удаляет брошенные картинки и их миниатюры.'''
+        kept = Post.objects.create(
+            text='Картинка остается',
+            author=self.user,
+            image=SimpleUploadedFile('kept.gif', get_test_image().read()),
+        )
+        image = BytesIO()
+        Image.new('RGB', (4, 4), 'blue').save(image, 'PNG')
+        dropped = Post.objects.create(
+            text='Картинку заменят',
+            author=self.user,
+            image=SimpleUploadedFile('dropped.png', image.getvalue()),
+        )
+        generate_thumbnails(dropped.image.name)
+        thumbnails = [
+            path for path, _, files in os.walk(TEMP_MEDIA_ROOT)
+            for name in files
+            if 'cache' in path
+        ]
+        self.assertTrue(thumbnails)
+        stray = os.path.join(TEMP_MEDIA_ROOT, 'cache', 'zz', 'stray.jpg')
+        os.makedirs(os.path.dirname(stray), exist_ok=True)
+        with open(stray, 'wb') as file:
+            file.write(b'stray')
+        dropped_path = dropped.image.path
+        # update() не отправляет сигналов: файл остается брошенным
+        Post.objects.filter(pk=dropped.pk).update(image='')
+
+        checkpoint = os.path.join(TEMP_MEDIA_ROOT, 'gc.json')
+        out = StringIO()
+        call_command(
+            'collect_media_garbage', min_age=0, batch_size=1, limit=1,
+            checkpoint=checkpoint, stdout=out,
+        )
+        self.assertTrue(os.path.exists(checkpoint))
+        call_command(
+            'collect_media_garbage', min_age=0, checkpoint=checkpoint,
+            stdout=out,
+        )
+
+        self.assertFalse(os.path.exists(checkpoint))
+        self.assertFalse(os.path.exists(dropped_path))
+        self.assertFalse(os.path.exists(stray))
+        self.assertTrue(os.path.exists(kept.image.path))
+        self.assertFalse(any(
+            'cache' in path and files
+            for path, _, files in os.walk(TEMP_MEDIA_ROOT)
+        ))
+        self.assertIn('освобождено байт', out.getvalue())
+
+    def test_collect_media_garbage_keeps_reused_file(self):
+        '''Повторная загрузка старой брошенной картинки ее сохраняет.'''
+        image = BytesIO()
+        Image.new('RGB', (4, 4), 'green').save(image, 'PNG')
+        content = image.getvalue()
+        dropped = Post.objects.create(
+            text='Картинку заменят',
+            author=self.user,
+            image=SimpleUploadedFile('old.png', content),
+        )
+        name = dropped.image.name
+        path = dropped.image.path
+        Post.objects.filter(pk=dropped.pk).update(image='')
+        os.utime(path, (0, 0))
+        # та же картинка загружена, а пост с ней еще не сохранен
+        storage = Post.image.field.storage
+        self.assertEqual(
+            storage.save('posts/new.png', SimpleUploadedFile(
+                'new.png', content
+            )),
+            name,
+        )
+
+        call_command('collect_media_garbage', stdout=StringIO())
+
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(StoredFile.objects.get(name=name).refs, 2)
@@ -1,7 +1,10 @@
+from io import StringIO
+
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.management import call_command
+from django.test import TestCase, override_settings
 
-from ..models import Group, Post
+from ..models import Comment, Follow, Group, Post, TimelineEntry, UserCounters
 
 User = get_user_model()
 
@@ -69,3 +72,156 @@ class PostTestModel(TestCase):
                         self.post._meta.get_field(value).help_text,
                         ''
                     )
+
+
+class TimelineTestModel(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.reader = User.objects.create_user(username='reader')
+        cls.author = User.objects.create_user(username='author')
+        cls.old_post = Post.objects.create(
+            author=cls.author,
+            text='Пост до подписки',
+        )
+
+    def test_follow_backfills_timeline(self):
+        '''Подписка добавляет в ленту уже опубликованные посты.'''
+        Follow.objects.create(user=self.reader, author=self.author)
+        self.assertTrue(TimelineEntry.objects.filter(
+            user=self.reader,
+            post=self.old_post,
+        ).exists())
+
+    def test_new_post_fans_out_to_followers(self):
+        '''Новый пост попадает в ленты подписчиков.'''
+        Follow.objects.create(user=self.reader, author=self.author)
+        post = Post.objects.create(author=self.author, text='Новый пост')
+        entry = TimelineEntry.objects.get(user=self.reader, post=post)
+        self.assertEqual(entry.pub_date, post.pub_date)
+
+    def test_unfollow_prunes_timeline(self):
+        '''Отписка убирает посты автора из ленты.'''
+        Follow.objects.create(user=self.reader, author=self.author)
+        Follow.objects.filter(user=self.reader, author=self.author).delete()
+        self.assertFalse(self.reader.timeline.exists())
+
+    @override_settings(FOLLOW_TIMELINE_LENGTH=2)
+    def test_timeline_is_bounded(self):
+        '''Лента не длиннее FOLLOW_TIMELINE_LENGTH, старые записи уходят.'''
+        Follow.objects.create(user=self.reader, author=self.author)
+        posts = [
+            Post.objects.create(author=self.author, text=str(i))
+            for i in range(3)
+        ]
+        self.assertEqual(
+            list(self.reader.timeline.values_list('post_id', flat=True)),
+            [posts[2].id, posts[1].id]
+        )
+
+
+class CountersTestModel(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.reader = User.objects.create_user(username='reader')
+        cls.author = User.objects.create_user(username='author')
+        cls.group = Group.objects.create(
+            title='Группа',
+            slug='group',
+            description='Описание',
+        )
+        cls.other_group = Group.objects.create(
+            title='Другая группа',
+            slug='other-group',
+            description='Описание',
+        )
+
+    def assertCounters(self, user, **expected):
+        counters = UserCounters.objects.get(user=user)
+        for field, value in expected.items():
+            with self.subTest(field=field):
+                self.assertEqual(getattr(counters, field), value)
+
+    def test_post_counters(self):
+        '''Счетчики постов автора и группы следуют за постами.'''
+        post = Post.objects.create(
+            author=self.author, text='Пост', group=self.group
+        )
+        self.assertCounters(self.author, posts_count=1)
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.posts_count, 1)
+
+        # перенос поста в другую группу
+        post = Post.objects.get(pk=post.pk)
+        post.group = self.other_group
+        post.save()
+        self.group.refresh_from_db()
+        self.other_group.refresh_from_db()
+        self.assertEqual(self.group.posts_count, 0)
+        self.assertEqual(self.other_group.posts_count, 1)
+
+        post.delete()
+        self.assertCounters(self.author, posts_count=0)
+        self.other_group.refresh_from_db()
+        self.assertEqual(self.other_group.posts_count, 0)
+
+    def test_comment_counters(self):
+        '''Счетчик комментариев поста следует за комментариями.'''
+        post = Post.objects.create(author=self.author, text='Пост')
+        comment = Comment.objects.create(
+            post=post, author=self.reader, text='Комментарий'
+        )
+        post.refresh_from_db()
+        self.assertEqual(post.comments_count, 1)
+        comment.delete()
+        post.refresh_from_db()
+        self.assertEqual(post.comments_count, 0)
+
+    def test_save_keeps_counters(self):
+        '''Сохранение загруженного раньше объекта не затирает счетчики.'''
+        post = Post.objects.create(
+            author=self.author, text='Пост', group=self.group
+        )
+        group = Group.objects.get(pk=self.group.pk)
+        loaded = Post.objects.get(pk=post.pk)
+        Comment.objects.create(
+            post=post, author=self.reader, text='Комментарий'
+        )
+        Post.objects.create(author=self.author, text='Еще', group=self.group)
+
+        loaded.text = 'Исправленный пост'
+        loaded.save()
+        group.title = 'Переименованная группа'
+        group.save()
+
+        loaded.refresh_from_db()
+        self.assertEqual(loaded.text, 'Исправленный пост')
+        self.assertEqual(loaded.comments_count, 1)
+        group.refresh_from_db()
+        self.assertEqual(group.title, 'Переименованная группа')
+        self.assertEqual(group.posts_count, 2)
+
+    def test_follow_counters(self):
+        '''Счетчики подписок и подписчиков следуют за подписками.'''
+        Follow.objects.create(user=self.reader, author=self.author)
+        self.assertCounters(self.reader, following_count=1)
+        self.assertCounters(self.author, followers_count=1)
+        Follow.objects.filter(user=self.reader).delete()
+        self.assertCounters(self.reader, following_count=0)
+        self.assertCounters(self.author, followers_count=0)
+
+    def test_recount_command_repairs_counters(self):
+        '''Команда recount_counters чинит счетчики после bulk_create.'''
+        Post.objects.bulk_create([
+            Post(author=self.author, text=str(i), group=self.group)
+            for i in range(3)
+        ])
+        UserCounters.objects.filter(user=self.reader).delete()
+        call_command('recount_counters', batch_size=1, stdout=StringIO())
+        self.assertCounters(self.author, posts_count=3)
+        self.assertCounters(self.reader, posts_count=0)
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.posts_count, 3)
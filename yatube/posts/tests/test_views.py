@@ -1,17 +1,28 @@
 import shutil
 import tempfile
+from datetime import timedelta
+from http import HTTPStatus
 
 from django import forms
 from django.conf import settings
+from django.contrib.admin.sites import site
 from django.contrib.auth import get_user_model
 from django.core.cache import cache
+from django.db import connection
 from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from sorl.thumbnail.images import serialize_image_file
+from sorl.thumbnail.kvstores.base import add_prefix
+from sorl.thumbnail.models import KVStore as KVStoreModel
 
 from test_utils import (assert_in, assert_is_instanse_fields, get_test_image,
                         search_post_by_text)
 
-from ..models import Follow, Group, Post
+from ..cache import post_version_key
+from ..fragments import render_post_fragments
+from ..images import POST_THUMBNAILS, prefetch_thumbnails, thumbnail_file
+from ..models import Comment, Follow, Group, Post
 
 User = get_user_model()
 
@@ -19,7 +30,10 @@ User = get_user_model()
 TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
 
 
-@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+# картинки и миниатюры обрабатываются сразу, в потоке теста
+@override_settings(
+    MEDIA_ROOT=TEMP_MEDIA_ROOT, IMAGE_INGEST_WORKERS=0, THUMBNAIL_WORKERS=0
+)
 class PostPagesTests(TestCase):
 
     @classmethod
@@ -272,11 +286,9 @@ class PostPagesTests(TestCase):
         response = self.authorized_client.get(reverse('posts:index'))
         origin_content = response.content.decode()
 
-        # Создаем еще один пост
-        self.post = Post.objects.create(
-            text='-------Еще один пост!!!!!---------',
-            author=self.user,
-            group=self.group,
+        # Меняем пост в обход сигналов
+        Post.objects.filter(pk=self.user_post2.pk).update(
+            text='-------Измененный в обход сигналов пост---------'
         )
 
         # Страница НЕ поменялась, т.е. выполнена выдача из кэша
@@ -298,6 +310,350 @@ class PostPagesTests(TestCase):
             'index.html НЕ поменялся после удаления кэша'
         )
 
+    def test_new_post_invalidates_cached_index(self):
+        '''Новый пост сразу появляется на закешированной главной.'''
+        self.authorized_client.get(reverse('posts:index') + '?page=1')
+        post = Post.objects.create(
+            text='-------Еще один пост!!!!!---------',
+            author=self.user,
+            group=self.group,
+        )
+        response = self.authorized_client.get(
+            reverse('posts:index') + '?page=1'
+        )
+        self.assertIsNotNone(search_post_by_text(
+            response.context['page_obj'],
+            post.text
+        ))
+
+    def test_cached_pages_are_not_kept_by_browsers(self):
+        '''
+        Срок серверного кеша не уходит клиенту, а личные страницы
+        не хранятся общими прокси.
+        '''
+        Follow.objects.create(user=self.user, author=self.user2)
+        for url in (reverse('posts:index'), reverse('posts:follow_index')):
+            with self.subTest(url=url):
+                for _ in range(2):
+                    response = self.authorized_client.get(url)
+                    cache_control = response['Cache-Control']
+                    self.assertIn('max-age=0', cache_control)
+                    self.assertIn('private', cache_control)
+
+    def test_post_fragment_cache(self):
+        '''Карточка поста берется из кеша до правки поста.'''
+        url = reverse('posts:group_list', kwargs={'slug': self.group.slug})
+        self.guest_client.get(url)
+
+        # Меняем текст в обход Post.updated: карточка из кеша
+        Post.objects.filter(pk=self.user2_post2.pk).update(
+            text='Измененный без смены версии текст'
+        )
+        response = self.guest_client.get(url)
+        self.assertNotContains(response, 'Измененный без смены версии')
+
+        # Правка через post_edit меняет версию карточки
+        author_client = Client()
+        author_client.force_login(self.user2)
+        author_client.post(
+            reverse('posts:post_edit', kwargs={
+                'post_id': self.user2_post2.id
+            }),
+            data={'text': 'Отредактированный текст', 'group': self.group.id}
+        )
+        response = self.guest_client.get(url)
+        self.assertContains(response, 'Отредактированный текст')
+
+    def test_post_fragment_follows_author_and_group(self):
+        '''Карточка меняется при смене имени автора и адреса группы.'''
+        def card():
+            post = Post.objects.for_feed().get(pk=self.user_post1.pk)
+            render_post_fragments([post])
+            return post.fragment
+
+        card()
+        author = User.objects.get(pk=self.user.pk)
+        author.first_name = 'Новое имя'
+        author.save()
+        self.assertIn('Новое имя', card())
+
+        group = Group.objects.get(pk=self.group.pk)
+        group.slug = 'renamed-group'
+        group.save()
+        self.assertIn('/group/renamed-group/', card())
+
+    def test_conditional_get(self):
+        '''Неизмененные страницы отвечают 304 до рендеринга.'''
+        urls = (
+            reverse('posts:post_detail', kwargs={
+                'post_id': self.user_post1.id
+            }),
+            reverse('posts:profile', kwargs={
+                'username': self.user.username
+            }),
+            reverse('posts:group_list', kwargs={'slug': self.group.slug}),
+        )
+        etags = {}
+        for url in urls:
+            with self.subTest(url=url):
+                etags[url] = self.authorized_client.get(url)['ETag']
+                response = self.authorized_client.get(
+                    url, HTTP_IF_NONE_MATCH=etags[url]
+                )
+                self.assertEqual(
+                    response.status_code, HTTPStatus.NOT_MODIFIED
+                )
+                self.assertEqual(response.templates, [])
+                # сжатая страница побайтно другая: ее ETag слабый
+                response = self.authorized_client.get(
+                    url, HTTP_ACCEPT_ENCODING='gzip'
+                )
+                self.assertEqual(response['Content-Encoding'], 'gzip')
+                self.assertEqual(response['ETag'], 'W/' + etags[url])
+                # у другого пользователя своя страница
+                response = self.guest_client.get(
+                    url, HTTP_IF_NONE_MATCH=etags[url]
+                )
+                self.assertEqual(response.status_code, HTTPStatus.OK)
+
+        # имя автора и описание группы меняют ETag своих страниц
+        author = User.objects.get(pk=self.user.pk)
+        author.first_name = 'Новое имя'
+        author.save()
+        group = Group.objects.get(pk=self.group.pk)
+        group.description = 'Новое описание'
+        group.save()
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.authorized_client.get(
+                    url, HTTP_IF_NONE_MATCH=etags[url]
+                )
+                self.assertEqual(response.status_code, HTTPStatus.OK)
+                etags[url] = response['ETag']
+
+        # новый комментарий и новый пост в группе меняют страницы
+        Comment.objects.create(
+            text='Новый комментарий',
+            author=self.user2,
+            post=self.user_post1,
+        )
+        Post.objects.create(
+            text='Новый пост в группе',
+            author=self.user,
+            group=self.group,
+        )
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.authorized_client.get(
+                    url, HTTP_IF_NONE_MATCH=etags[url]
+                )
+                self.assertEqual(response.status_code, HTTPStatus.OK)
+
+    def test_pages_cached(self):
+        '''
+        Группа, профиль и пост кешируются для всех пользователей
+        и сбрасываются при изменении их содержимого.
+        '''
+        urls = (
+            reverse('posts:post_detail', kwargs={
+                'post_id': self.user_post1.id
+            }),
+            reverse('posts:profile', kwargs={
+                'username': self.user.username
+            }),
+            reverse('posts:group_list', kwargs={'slug': self.group.slug}),
+        )
+        for url in urls:
+            self.guest_client.get(url)
+
+        # Меняем пост в обход сигналов
+        Post.objects.filter(pk=self.user_post1.pk).update(
+            text='Измененный в обход сигналов пост',
+            updated=self.user_post1.updated + timedelta(seconds=1),
+        )
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.guest_client.get(url)
+                self.assertNotContains(response, 'Измененный в обход')
+
+        # комментарий сбрасывает страницу поста
+        Comment.objects.create(
+            text='Комментарий для анонимов',
+            author=self.user2,
+            post=self.user_post1,
+        )
+        for client in (self.guest_client, self.authorized_client):
+            response = client.get(urls[0])
+            self.assertContains(response, 'Комментарий для анонимов')
+
+        # новый пост автора сбрасывает профиль и группу, а страницы
+        # его прежних постов остаются в кеше с новым кол-вом постов
+        post_version = cache.get(post_version_key(self.user_post1.id))
+        Post.objects.create(
+            text='Новый пост автора',
+            author=self.user,
+            group=self.group,
+        )
+        for url in urls[1:]:
+            with self.subTest(url=url):
+                response = self.guest_client.get(url)
+                self.assertContains(response, 'Новый пост автора')
+        self.assertEqual(
+            cache.get(post_version_key(self.user_post1.id)), post_version
+        )
+        response = self.guest_client.get(urls[0])
+        self.assertContains(response, '<span>3</span>', html=False)
+
+        # смена имени автора видна на его посте, в профиле
+        # и в карточках его постов на странице группы
+        self.user.first_name = 'Переименованный'
+        self.user.save()
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.guest_client.get(url)
+                self.assertContains(response, 'Переименованный')
+
+    def test_group_change_resets_pages_of_its_posts(self):
+        '''
+        Новый адрес группы и ее удаление видны в профиле и на страницах
+        ее постов, а также в лентах подписчиков их авторов.
+        '''
+        Follow.objects.create(user=self.user3, author=self.user)
+        urls = (
+            reverse('posts:post_detail', kwargs={
+                'post_id': self.user_post1.id
+            }),
+            reverse('posts:profile', kwargs={
+                'username': self.user.username
+            }),
+        )
+        follow_url = reverse('posts:follow_index')
+        for url in urls:
+            self.guest_client.get(url)
+        self.authorized_client3.get(follow_url)
+
+        group = Group.objects.get(pk=self.group.pk)
+        group.slug = 'renamed-group'
+        group.save()
+        for client, url in (
+            *((self.guest_client, url) for url in urls),
+            (self.authorized_client3, follow_url),
+        ):
+            with self.subTest(url=url):
+                response = client.get(url)
+                self.assertContains(response, '/group/renamed-group/')
+                self.assertNotContains(response, '/group/testGroup/')
+
+        group.delete()
+        for client, url in (
+            *((self.guest_client, url) for url in urls),
+            (self.authorized_client3, follow_url),
+        ):
+            with self.subTest(url=url):
+                response = client.get(url)
+                self.assertNotContains(response, '/group/renamed-group/')
+
+    def test_signed_in_users_share_cached_pages(self):
+        '''
+        Вошедший пользователь получает общую серверную копию страницы:
+        ее сбрасывают сигналы, а браузер и прокси ее не хранят.
+        '''
+        url = reverse('posts:index')
+        self.guest_client.get(url)
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.authorized_client.get(url)
+        self.assertFalse(any(
+            Post._meta.db_table in query['sql']
+            for query in context.captured_queries
+        ))
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('max-age=0', response['Cache-Control'])
+
+        self.user_post1.text = 'Исправленный автором пост'
+        self.user_post1.save()
+        response = self.authorized_client.get(url)
+        self.assertContains(response, 'Исправленный автором пост')
+
+    def test_personal_parts_of_cached_pages(self):
+        '''Личные части общей закешированной страницы у каждого свои.'''
+        Follow.objects.create(user=self.user3, author=self.user)
+        url = reverse('posts:profile', kwargs={'username': self.user.username})
+        self.guest_client.get(url)
+
+        response = self.authorized_client3.get(url)
+        self.assertContains(response, f'Пользователь: {self.user3.username}')
+        self.assertContains(response, reverse(
+            'posts:profile_unfollow', kwargs={'username': self.user.username}
+        ))
+        response = self.guest_client.get(url)
+        self.assertNotContains(response, 'Пользователь:')
+        self.assertContains(response, reverse(
+            'posts:profile_follow', kwargs={'username': self.user.username}
+        ))
+
+        url = reverse('posts:post_detail', kwargs={
+            'post_id': self.user_post1.id
+        })
+        self.guest_client.get(url)
+        response = self.authorized_client.get(url)
+        self.assertContains(response, 'csrfmiddlewaretoken')
+        self.assertContains(response, reverse(
+            'posts:post_edit', kwargs={'post_id': self.user_post1.id}
+        ))
+        response = self.authorized_client3.get(url)
+        self.assertContains(response, 'csrfmiddlewaretoken')
+        self.assertNotContains(response, 'редактировать запись')
+        response = self.guest_client.get(url)
+        self.assertNotContains(response, 'csrfmiddlewaretoken')
+
+    def test_not_found_under_cached_page(self):
+        '''404 на закешированной странице рендерится без меток дыр.'''
+        urls = (
+            reverse('posts:profile', kwargs={'username': 'nobody'}),
+            reverse('posts:group_list', kwargs={'slug': 'nothing'}),
+            reverse('posts:post_detail', kwargs={'post_id': 0}),
+        )
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.guest_client.get(url)
+                self.assertEqual(response.status_code, HTTPStatus.NOT_FOUND)
+                self.assertNotContains(
+                    response, '<!--hole:', status_code=HTTPStatus.NOT_FOUND
+                )
+                self.assertContains(
+                    response, 'Войти', status_code=HTTPStatus.NOT_FOUND
+                )
+
+    def test_prefetch_thumbnails(self):
+        '''Миниатюры страницы находятся одним запросом.'''
+        posts = [
+            Post.objects.create(
+                text=f'Пост с картинкой {i}',
+                author=self.user,
+                image=f'posts/prefetch_{i}.gif',
+            )
+            for i in range(3)
+        ]
+        geometry, options = POST_THUMBNAILS[0]
+        ready = thumbnail_file(posts[0].image, geometry, **options)
+        ready.set_size((960, 339))
+        KVStoreModel.objects.create(
+            key=add_prefix(ready.key),
+            value=serialize_image_file(ready),
+        )
+        cache.clear()
+
+        with self.assertNumQueries(1):
+            prefetch_thumbnails(posts)
+        self.assertEqual(posts[0].thumbnail.url, ready.url)
+        self.assertIsNone(posts[1].thumbnail)
+
+        # второй раз все, в том числе отсутствие записей, в кеше
+        with self.assertNumQueries(0):
+            prefetch_thumbnails(posts)
+        self.assertEqual(posts[0].thumbnail.url, ready.url)
+
     def test_authorized_client_can_follow(self):
         '''Авторизованный пользователь может подписываться.'''
         # подписываемся
@@ -368,6 +724,28 @@ class PostPagesTests(TestCase):
             post.text
         ))
 
+    def test_follow_page_is_cached_per_user(self):
+        '''Лента подписок отдается из кеша до подписки или нового поста.'''
+        Follow.objects.create(user=self.user, author=self.user2)
+        url = reverse('posts:follow_index')
+        self.authorized_client.get(url)
+
+        with CaptureQueriesContext(connection) as context:
+            self.authorized_client.get(url)
+        self.assertFalse(any(
+            Post._meta.db_table in query['sql']
+            for query in context.captured_queries
+        ))
+
+        # другой пользователь не получает чужую ленту
+        response = self.authorized_client3.get(url)
+        self.assertEqual(len(response.context['page_obj']), 0)
+
+        # подписка сбрасывает ленту
+        Follow.objects.create(user=self.user3, author=self.user)
+        response = self.authorized_client3.get(url)
+        self.assertEqual(len(response.context['page_obj']), 2)
+
     def test_other_user_doesnt_see_author_new_post(self):
         '''Подписчик видит новую запись автора.'''
 
@@ -460,3 +838,168 @@ class PaginatorViewsTest(TestCase):
             len(response.context['page_obj']),
             self.user2.posts.count()
         )
+
+    def test_index_cursor_pages(self):
+        '''Проверка: курсорная пагинация отдает все посты по порядку.'''
+        response = self.client.get(reverse('posts:index') + '?cursor=')
+        first_page = response.context['page_obj']
+        self.assertTrue(first_page.is_cursor)
+        self.assertEqual(len(first_page), 10)
+        self.assertFalse(first_page.has_previous())
+
+        response = self.client.get(
+            reverse('posts:index') + '?cursor=' + first_page.next_cursor
+        )
+        second_page = response.context['page_obj']
+        self.assertEqual(len(second_page), 3)
+        self.assertFalse(second_page.has_next())
+        self.assertEqual(
+            [post.id for post in first_page]
+            + [post.id for post in second_page],
+            list(Post.objects.values_list('id', flat=True))
+        )
+
+        # возвращаемся назад
+        response = self.client.get(
+            reverse('posts:index') + '?cursor=' + second_page.previous_cursor
+        )
+        self.assertEqual(
+            [post.id for post in response.context['page_obj']],
+            [post.id for post in first_page]
+        )
+
+    def test_invalid_cursor_shows_first_page(self):
+        '''Проверка: некорректный курсор отдает первую страницу.'''
+        response = self.client.get(reverse(
+            'posts:group_list',
+            kwargs={'slug': self.group.slug}
+        ) + '?cursor=broken')
+        assert_in(self, 'page_obj', response.context)
+        self.assertEqual(
+            [post.id for post in response.context['page_obj']],
+            list(self.group.posts.values_list('id', flat=True)[:10])
+        )
+
+    def test_feed_queries_do_not_depend_on_page_size(self):
+        '''Проверка: число запросов не зависит от кол-ва постов.'''
+        queries = []
+        for page in (1, 2):
+            cache.clear()
+            with CaptureQueriesContext(connection) as context:
+                self.client.get(reverse('posts:index') + f'?page={page}')
+            queries.append(len(context))
+        self.assertEqual(queries[0], queries[1])
+
+    def test_post_detail_queries_do_not_depend_on_comments(self):
+        '''Проверка: число запросов не зависит от кол-ва комментариев.'''
+        post = Post.objects.first()
+        url = reverse('posts:post_detail', kwargs={'post_id': post.id})
+        queries = []
+        for author in (self.user, self.user2):
+            Comment.objects.create(post=post, author=author, text='Текст')
+            with CaptureQueriesContext(connection) as context:
+                self.client.get(url)
+            queries.append(len(context))
+        self.assertEqual(queries[0], queries[1])
+
+    def test_index_count_is_served_from_cache(self):
+        '''Проверка: кол-во постов главной берется из кеша.'''
+        self.client.get(reverse('posts:index'))
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('posts:index') + '?page=2')
+        self.assertEqual(response.context['page_obj'].paginator.count, 13)
+        self.assertFalse(
+            any('COUNT(' in query['sql'] for query in context.captured_queries)
+        )
+
+    def test_follow_pages_without_count(self):
+        '''Проверка: лента подписок листается без COUNT(*).'''
+        Follow.objects.create(user=self.user, author=self.user2)
+        with CaptureQueriesContext(connection) as context:
+            response = self.authorized_client.get(
+                reverse('posts:follow_index')
+            )
+        page_obj = response.context['page_obj']
+        self.assertEqual(len(page_obj), 6)
+        self.assertFalse(page_obj.has_next())
+        self.assertFalse(
+            any('COUNT(' in query['sql'] for query in context.captured_queries)
+        )
+
+
+class SearchViewsTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.user = User.objects.create_user(username='auth')
+        cls.user2 = User.objects.create_user(username='auth2')
+        cls.group = Group.objects.create(
+            title="Тестовая группа",
+            slug="testGroup",
+            description="Описание тестовой группы"
+        )
+        cls.cat_post = Post.objects.create(
+            text='Котик спит на диване',
+            author=cls.user,
+            group=cls.group,
+        )
+        cls.cats_post = Post.objects.create(
+            text='Котик, еще котик и снова котик',
+            author=cls.user2,
+        )
+        cls.dog_post = Post.objects.create(
+            text='Пёс охраняет дом',
+            author=cls.user,
+        )
+
+    def search(self, **params):
+        response = self.client.get(reverse('posts:search'), params)
+        return response.context['posts'], response.context['next_cursor']
+
+    def test_search_ranks_results(self):
+        '''Поиск находит посты по слову, лучшие совпадения первыми.'''
+        posts, next_cursor = self.search(q='котик')
+        self.assertEqual(posts, [self.cats_post, self.cat_post])
+        self.assertIsNone(next_cursor)
+
+    def test_search_filters(self):
+        '''Поиск фильтрует по группе и автору.'''
+        posts, _ = self.search(q='котик', group=self.group.slug)
+        self.assertEqual(posts, [self.cat_post])
+        posts, _ = self.search(q='котик', author=self.user2.username)
+        self.assertEqual(posts, [self.cats_post])
+        posts, _ = self.search(q='котик', author='nobody')
+        self.assertEqual(posts, [])
+
+    def test_search_sees_updates(self):
+        '''Индекс следует за изменениями текста, в том числе update().'''
+        Post.objects.filter(pk=self.dog_post.pk).update(text='Пёс и котик')
+        posts, _ = self.search(q='пёс')
+        self.assertEqual(posts, [self.dog_post])
+        self.cat_post.delete()
+        posts, _ = self.search(q='котик')
+        self.assertEqual(len(posts), 2)
+
+    def test_search_cursor(self):
+        '''Курсор поиска отдает следующую страницу.'''
+        Post.objects.bulk_create([
+            Post(text=f'котик номер {i}', author=self.user)
+            for i in range(11)
+        ])
+        posts, next_cursor = self.search(q='котик')
+        self.assertEqual(len(posts), 10)
+        more, last_cursor = self.search(q='котик', cursor=next_cursor)
+        self.assertEqual(len(more), 3)
+        self.assertIsNone(last_cursor)
+        self.assertFalse(set(posts) & set(more))
+
+    def test_admin_search_uses_index(self):
+        '''Поиск в админке идет через полнотекстовый индекс.'''
+        admin_model = site._registry[Post]
+        queryset, _ = admin_model.get_search_results(
+            None, Post.objects.all(), 'котик'
+        )
+        self.assertEqual(
+            set(queryset),
+            {self.cat_post, self.cats_post}
+        )
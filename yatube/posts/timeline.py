@@ -0,0 +1,87 @@
+'''
+Лента подписок, материализованная при публикации (fan-out on write).
+
+Каждому подписчику автора при создании поста добавляется запись
+TimelineEntry, поэтому страница /follow/ читается одним диапазоном
+индекса (user, pub_date) без соединения с Follow.
+Посты, созданные через bulk_create, сигналов не отправляют
+и в ленты не попадают.
+'''
+from typing import Iterable
+
+from django.conf import settings
+from django.db import connection
+
+from .models import Follow, Post, TimelineEntry
+
+# Ограничение на кол-во параметров в одном запросе SQLite
+BATCH_SIZE = 500
+
+
+def _batches(items: list, size: int = BATCH_SIZE) -> Iterable[list]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def trim_timeline(user_ids: Iterable[int]) -> None:
+    '''Обрезаем ленты пользователей до FOLLOW_TIMELINE_LENGTH записей.'''
+
+    table = connection.ops.quote_name(TimelineEntry._meta.db_table)
+    for batch in _batches(list(user_ids)):
+        placeholders = ', '.join(['%s'] * len(batch))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {table} WHERE id IN ('
+                f'SELECT id FROM ('
+                f'SELECT id, ROW_NUMBER() OVER ('
+                f'PARTITION BY user_id ORDER BY pub_date DESC, post_id DESC'
+                f') AS position FROM {table} '
+                f'WHERE user_id IN ({placeholders})'
+                f') ranked WHERE position > %s)',
+                batch + [settings.FOLLOW_TIMELINE_LENGTH]
+            )
+
+
+def fan_out_post(post: Post) -> None:
+    '''Раскладываем новый пост по лентам подписчиков автора.'''
+
+    follower_ids = list(Follow.objects.filter(
+        author_id=post.author_id
+    ).values_list('user_id', flat=True))
+
+    TimelineEntry.objects.bulk_create(
+        (
+            TimelineEntry(user_id=user_id, post=post, pub_date=post.pub_date)
+            for user_id in follower_ids
+        ),
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    trim_timeline(follower_ids)
+
+
+def backfill_timeline(user_id: int, author_id: int) -> None:
+    '''Добавляем в ленту подписчика последние посты автора.'''
+
+    posts = Post.objects.filter(author_id=author_id).values_list(
+        'pk', 'pub_date'
+    )[:settings.FOLLOW_TIMELINE_LENGTH]
+
+    TimelineEntry.objects.bulk_create(
+        (
+            TimelineEntry(user_id=user_id, post_id=pk, pub_date=pub_date)
+            for pk, pub_date in posts
+        ),
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    trim_timeline([user_id])
+
+
+def prune_timeline(user_id: int, author_id: int) -> None:
+    '''Убираем из ленты подписчика посты автора.'''
+
+    TimelineEntry.objects.filter(
+        user_id=user_id,
+        post__author_id=author_id,
+    ).delete()
@@ -23,6 +23,8 @@ urlpatterns = [
         views.add_comment,
         name='add_comment'
     ),
+    # Поиск
+    path('search/', views.search, name='search'),
     # Избранный авторы
     path('follow/', views.follow_index, name='follow_index'),
     # подписаться на автора
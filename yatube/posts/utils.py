@@ -1,13 +1,242 @@
-from django.core.paginator import Page, Paginator
-from django.db.models import QuerySet
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import (EmptyPage, InvalidPage, Page,
+                                   PageNotAnInteger, Paginator)
+from django.db.models import Q, QuerySet
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_bytes, force_str
+from django.utils.functional import cached_property
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
+
+# Направление курсора: вперед (к более старым постам) и назад
+CURSOR_NEXT = 'n'
+CURSOR_PREVIOUS = 'p'
+
+
+class InvalidCursor(InvalidPage):
+    pass
+
+
+def encode_cursor(direction: str, *values) -> str:
+    '''Упаковываем направление и значения ключа в непрозрачный токен.'''
+
+    raw = '|'.join([direction] + [str(value) for value in values])
+    return urlsafe_base64_encode(force_bytes(raw))
+
+
+def decode_cursor(cursor: str) -> list:
+    '''Распаковываем токен курсора в список строк.'''
+
+    try:
+        return force_str(urlsafe_base64_decode(cursor)).split('|')
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidCursor('Некорректный курсор')
+
+
+class CursorPage(Page):
+    '''
+    Страница курсорной пагинации.
+    Номера страницы нет, вместо него токены
+    соседних страниц next_cursor и previous_cursor.
+    '''
+
+    is_cursor = True
+
+    def __init__(self, object_list, paginator,
+                 next_cursor=None, previous_cursor=None):
+        super().__init__(object_list, None, paginator)
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return '<CursorPage {}>'.format(len(self.object_list))
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+class CursorPaginator(Paginator):
+    '''
+    Пагинатор по ключу (pub_date, id) без COUNT(*) и OFFSET:
+    стоимость любой страницы равна стоимости первой.
+    '''
+
+    def _make_cursor(self, direction: str, post) -> str:
+        return encode_cursor(direction, post.pub_date.isoformat(), post.pk)
+
+    def _parse_cursor(self, cursor: str):
+        try:
+            direction, pub_date, pk = decode_cursor(cursor)
+            pub_date = parse_datetime(pub_date)
+            pk = int(pk)
+        except (ValueError, InvalidCursor):
+            raise InvalidCursor('Некорректный курсор')
+        if pub_date is None or direction not in (
+            CURSOR_NEXT, CURSOR_PREVIOUS
+        ):
+            raise InvalidCursor('Некорректный курсор')
+        return direction, pub_date, pk
+
+    def page(self, cursor: str = None) -> CursorPage:
+        posts = self.object_list
+        limit = self.per_page
+
+        if not cursor:
+            items = list(posts.order_by('-pub_date', '-pk')[:limit + 1])
+            has_more, items = len(items) > limit, items[:limit]
+            return CursorPage(
+                items,
+                self,
+                next_cursor=(
+                    self._make_cursor(CURSOR_NEXT, items[-1])
+                    if has_more else None
+                ),
+            )
+
+        direction, pub_date, pk = self._parse_cursor(cursor)
+
+        if direction == CURSOR_NEXT:
+            items = list(posts.filter(
+                Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, pk__lt=pk)
+            ).order_by('-pub_date', '-pk')[:limit + 1])
+            has_more, items = len(items) > limit, items[:limit]
+            has_next, has_previous = has_more, True
+        else:
+            items = list(posts.filter(
+                Q(pub_date__gt=pub_date) | Q(pub_date=pub_date, pk__gt=pk)
+            ).order_by('pub_date', 'pk')[:limit + 1])
+            has_more, items = len(items) > limit, items[:limit][::-1]
+            has_next, has_previous = True, has_more
+
+        if not items:
+            return self.page(None)
+
+        return CursorPage(
+            items,
+            self,
+            next_cursor=(
+                self._make_cursor(CURSOR_NEXT, items[-1])
+                if has_next else None
+            ),
+            previous_cursor=(
+                self._make_cursor(CURSOR_PREVIOUS, items[0])
+                if has_previous else None
+            ),
+        )
+
+    def get_page(self, cursor: str = None) -> CursorPage:
+        try:
+            return self.page(cursor)
+        except InvalidCursor:
+            return self.page(None)
+
+
+class CountedPaginator(Paginator):
+    '''
+    Пагинатор, которому общее кол-во объектов передают готовым,
+    например из денормализованного счетчика. Кол-во может устареть,
+    поэтому срез страницы по нему не обрезается.
+    '''
+
+    def __init__(self, object_list, per_page, count=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        if count is not None:
+            self.count = count
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        return self._get_page(
+            self.object_list[bottom:bottom + self.per_page],
+            number,
+            self
+        )
+
+
+class CachedCountPaginator(CountedPaginator):
+    '''
+    Пагинатор, который берет общее кол-во объектов из кеша
+    по ключу count_key; кол-во может устареть на count_timeout секунд.
+    '''
+
+    def __init__(self, object_list, per_page, count_key,
+                 count_timeout=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count_key = count_key
+        self.count_timeout = (
+            settings.POSTS_COUNT_CACHE_TIMEOUT
+            if count_timeout is None else count_timeout
+        )
+
+    @cached_property
+    def count(self):
+        count = cache.get(self.count_key)
+        if count is None:
+            count = self.object_list.count()
+            cache.set(self.count_key, count, self.count_timeout)
+        return count
+
+
+class ProbePaginator(Paginator):
+    '''
+    Пагинатор без COUNT(*): наличие следующей страницы
+    проверяем, выбирая per_page + 1 объектов.
+    count после выборки страницы - лишь нижняя оценка.
+    '''
+
+    countless = True
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('Номер страницы не является числом')
+        if number < 1:
+            raise EmptyPage('Номер страницы меньше 1')
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        items = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not items and number > 1:
+            raise EmptyPage('На странице нет объектов')
+        self.count = bottom + len(items)
+        return self._get_page(items[:self.per_page], number, self)
+
+    def get_page(self, number):
+        try:
+            return self.page(number)
+        except InvalidPage:
+            return self.page(1)
 
 
 def get_page_object(
     posts: QuerySet,
     page_number: int,
-    per_page: int = 10
+    per_page: int = 10,
+    cursor: str = None,
+    count: int = None,
+    count_key: str = None,
 ) -> Page:
-    '''Получаем объект страницы.'''
+    '''
+    Получаем объект страницы.
+    Если передан cursor (в том числе пустой), используется
+    курсорная пагинация. Иначе постраничная: с готовым кол-вом
+    постов count, с кол-вом из кеша по count_key,
+    а без них - без подсчета вовсе.
+    '''
+
+    if cursor is not None:
+        return CursorPaginator(posts, per_page).get_page(cursor)
 
-    paginator = Paginator(posts, per_page)
+    if count is not None:
+        paginator = CountedPaginator(posts, per_page, count)
+    elif count_key is not None:
+        paginator = CachedCountPaginator(posts, per_page, count_key)
+    else:
+        paginator = ProbePaginator(posts, per_page)
     return paginator.get_page(page_number)
@@ -1,84 +1,163 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import get_object_or_404, redirect, render
-from django.views.decorators.cache import cache_page
-
-from .forms import CommentForm, PostForm
+from django.views.decorators.http import condition
+
+from core.cache import cache_page_versioned
+
+from .cache import (INDEX_VERSION_KEY, POSTS_COUNT_KEY, follow_version_keys,
+                    group_version_keys, post_version_keys,
+                    profile_version_keys)
+from .conditions import (group_etag, group_last_modified, post_detail_etag,
+                         post_detail_last_modified, profile_etag,
+                         profile_last_modified)
+from .counters import get_user_counters
+from .forms import CommentForm, PostForm, SearchForm
+from .fragments import render_post_fragments
+from .ingest import ingest_post_image, stage_post_image
 from .models import Follow, Group, Post
+from .search import search_posts
 from .utils import get_page_object
 
 User = get_user_model()
 
 
-@cache_page(20, key_prefix="index_page")
+@cache_page_versioned(
+    settings.INDEX_PAGE_CACHE_TIMEOUT,
+    key_prefix="index_page",
+    version_keys=[INDEX_VERSION_KEY],
+    shell=True,
+)
 def index(request):
 
-    posts = Post.objects.all()
+    posts = Post.objects.for_feed()
+    page_obj = get_page_object(
+        posts,
+        request.GET.get('page'),
+        cursor=request.GET.get('cursor'),
+        count_key=POSTS_COUNT_KEY,
+    )
+    render_post_fragments(page_obj)
 
     context = {
-        'page_obj': get_page_object(
-            posts,
-            request.GET.get('page')
-        )
+        'page_obj': page_obj
     }
 
     return render(request, 'posts/index.html', context)
 
 
+@condition(etag_func=group_etag, last_modified_func=group_last_modified)
+@cache_page_versioned(
+    settings.ANONYMOUS_PAGE_CACHE_TIMEOUT,
+    key_prefix="group_page",
+    version_keys=group_version_keys,
+    shell=True,
+)
 def group_posts(request, slug):
 
     group = get_object_or_404(Group, slug=slug)
-    posts = group.posts.all()
+    posts = group.posts.for_feed()
+    page_obj = get_page_object(
+        posts,
+        request.GET.get('page'),
+        cursor=request.GET.get('cursor'),
+        count=group.posts_count,
+    )
+    render_post_fragments(page_obj)
     context = {
         'group': group,
-        'page_obj': get_page_object(
-            posts,
-            request.GET.get('page')
-        ),
+        'page_obj': page_obj,
     }
 
     return render(request, 'posts/group_list.html', context)
 
 
+@condition(etag_func=profile_etag, last_modified_func=profile_last_modified)
+@cache_page_versioned(
+    settings.ANONYMOUS_PAGE_CACHE_TIMEOUT,
+    key_prefix="profile_page",
+    version_keys=profile_version_keys,
+    shell=True,
+)
 def profile(request, username):
 
-    user = get_object_or_404(User, username=username)
-
-    following = (
-        (request.user.is_authenticated)
-        and (user != request.user)
+    user = get_object_or_404(
+        User.objects.select_related('counters'),
+        username=username
     )
+    counters = get_user_counters(user)
 
-    if following:
-        following = Follow.objects.filter(
-            user=request.user,
-            author=user,
-        ).exists()
+    page_obj = get_page_object(
+        user.posts.for_feed(),
+        request.GET.get('page'),
+        cursor=request.GET.get('cursor'),
+        count=counters.posts_count,
+    )
+    render_post_fragments(page_obj)
 
     context = {
         'author': user,
-        'page_obj': get_page_object(
-            user.posts.all(),
-            request.GET.get('page')
-        ),
-        'following': following,
+        'page_obj': page_obj,
+        'posts_count': counters.posts_count,
     }
     return render(request, 'posts/profile.html', context)
 
 
+@condition(
+    etag_func=post_detail_etag,
+    last_modified_func=post_detail_last_modified,
+)
+@cache_page_versioned(
+    settings.ANONYMOUS_PAGE_CACHE_TIMEOUT,
+    key_prefix="post_page",
+    version_keys=post_version_keys,
+    shell=True,
+)
 def post_detail(request, post_id):
 
-    post = get_object_or_404(Post, pk=post_id)
+    post = get_object_or_404(Post.objects.for_detail(), pk=post_id)
 
     context = {
         'post': post,
         'form': CommentForm(),
-        'comments': post.comments.all()
+        'comments': post.comments.for_list()
     }
 
     return render(request, 'posts/post_detail.html', context)
 
 
+def search(request):
+
+    form = SearchForm(request.GET or None)
+    posts, next_cursor = [], None
+
+    if form.is_valid():
+        group = form.cleaned_data['group']
+        username = form.cleaned_data['author']
+        author = User.objects.filter(username=username).first()
+        # неизвестный автор - пустая выдача
+        if not username or author is not None:
+            posts, next_cursor = search_posts(
+                form.cleaned_data['q'],
+                group_id=group.pk if group else None,
+                author_id=author.pk if author else None,
+                cursor=request.GET.get('cursor'),
+            )
+            render_post_fragments(posts)
+
+    query = request.GET.copy()
+    query.pop('cursor', None)
+
+    context = {
+        'form': form,
+        'posts': posts,
+        'next_cursor': next_cursor,
+        'query': query.urlencode(),
+    }
+    return render(request, 'posts/search.html', context)
+
+
 @login_required
 def post_create(request):
 
@@ -88,9 +167,12 @@ def post_create(request):
     )
 
     if form.is_valid():
+        # картинка прикрепится к посту после перекодирования
+        image_job = stage_post_image(form)
         post = form.save(commit=False)
         post.author = request.user
         post.save()
+        ingest_post_image(post, image_job)
         return redirect('posts:profile', request.user.username)
 
     return render(
@@ -115,7 +197,9 @@ def post_edit(request, post_id):
     )
 
     if form.is_valid():
+        image_job = stage_post_image(form)
         form.save()
+        ingest_post_image(post, image_job)
         # Перенаправляем на информацию о посте
         return redirect('posts:post_detail', post_id=post_id)
 
@@ -142,14 +226,26 @@ def add_comment(request, post_id):
 
 
 @login_required
+@cache_page_versioned(
+    settings.FOLLOW_PAGE_CACHE_TIMEOUT,
+    key_prefix="follow_page",
+    version_keys=follow_version_keys,
+    private=True,
+)
 def follow_index(request):
-    posts = Post.objects.filter(author__following__user=request.user)
+    # лента материализована в TimelineEntry, см. posts.timeline
+    posts = Post.objects.for_feed().filter(
+        timeline_entries__user=request.user
+    ).order_by('-timeline_entries__pub_date', '-timeline_entries__post')
+    page_obj = get_page_object(
+        posts,
+        request.GET.get('page'),
+        cursor=request.GET.get('cursor'),
+    )
+    render_post_fragments(page_obj)
 
     context = {
-        'page_obj': get_page_object(
-            posts,
-            request.GET.get('page')
-        )
+        'page_obj': page_obj
     }
 
     return render(request, 'posts/follow.html', context)
@@ -25,6 +25,15 @@ LOGIN_REDIRECT_URL = 'posts:index'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Отдача медиа через фронтовой прокси: None, 'x-accel-redirect'
+# (nginx, internal-локация MEDIA_ACCEL_PREFIX) или 'x-sendfile'
+MEDIA_SENDFILE = None
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+
+# Время жизни в кеше клиента для медиа с изменяемым содержимым;
+# файлы с именем по хешу кешируются на год
+MEDIA_CACHE_MAX_AGE = 60 * 60
+
 EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
 EMAIL_FILE_PATH = os.path.join(BASE_DIR, 'sent_emails')
 
@@ -98,12 +107,82 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Один кеш на все процессы сервера, см. core.backends.sqlite,
+# и перед ним ближний кеш процесса, см. core.backends.near.
+# Без ближнего кеша 'shared' можно сделать 'default'
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'BACKEND': 'core.backends.near.NearCache',
+        'LOCATION': 'shared',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+            'LOCAL_TIMEOUT': 5,
+            'STAMP_INTERVAL': 1,
+        },
+    },
+    'shared': {
+        'BACKEND': 'core.backends.sqlite.SQLiteCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache.sqlite3'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+            'MAX_BYTES': 64 * 1024 * 1024,
+            'COMPRESS_MIN_SIZE': 1024,
+        },
     }
 }
 
+# Тесты работают со своими файлами кешей, см. core.test_runner
+TEST_RUNNER = 'core.test_runner.TestRunner'
+
+# Главная страница сбрасывается сигналами, поэтому TTL большой
+INDEX_PAGE_CACHE_TIMEOUT = 60 * 60 * 4
+
+# Допустимое устаревание кол-ва постов в пагинаторе, сек.
+POSTS_COUNT_CACHE_TIMEOUT = 60 * 5
+
+# Лента подписок кешируется для каждого пользователя отдельно
+FOLLOW_PAGE_CACHE_TIMEOUT = 60 * 60
+
+# Одновременные промахи по странице считает один запрос.
+# Остальные отдают устаревшую копию, которая хранится еще
+# PAGE_CACHE_STALE_TIMEOUT после своего TTL, или ждут расчета
+# не дольше PAGE_CACHE_LOCK_WAIT. Блокировка снимается сама
+# через PAGE_CACHE_LOCK_TIMEOUT, если считавший запрос упал
+PAGE_CACHE_STALE_TIMEOUT = 60 * 5
+PAGE_CACHE_LOCK_WAIT = 2
+PAGE_CACHE_LOCK_TIMEOUT = 30
+
+# Сколько браузер может показывать закешированную страницу без
+# проверки, сек. *_PAGE_CACHE_TIMEOUT - сроки только серверного
+# кеша: его сбрасывают сигналы, а копию в браузере сбросить нельзя
+PAGE_CACHE_CLIENT_MAX_AGE = 0
+
+# Каркасы страниц групп, профилей и постов, общие для всех
+# пользователей (имя осталось с тех пор, когда кешировались
+# только страницы анонимов); сбрасываются
+# сигналами при изменении их постов, комментариев, группы или автора
+ANONYMOUS_PAGE_CACHE_TIMEOUT = 60 * 60
+
+# Карточка поста в кеше, ключ меняется при правке поста
+POST_FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Загрузки пишутся на диск кусками, а не держатся в памяти
+FILE_UPLOAD_HANDLERS = [
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
+# Ограничения на картинку поста: размер файла и кол-во пикселей
+POST_IMAGE_MAX_SIZE = 20 * 1024 * 1024
+POST_IMAGE_MAX_PIXELS = 40 * 1000 * 1000
+
+# Процессы, перекодирующие загруженные картинки.
+# 0 - перекодировать сразу, в потоке запроса
+IMAGE_INGEST_WORKERS = 2
+
+# Потоки пула, создающего миниатюры после загрузки картинки.
+# 0 - создавать миниатюры сразу, в потоке запроса
+THUMBNAIL_WORKERS = 2
+
 LANGUAGE_CODE = 'ru'
 
 TIME_ZONE = 'UTC'
@@ -116,3 +195,6 @@ USE_TZ = True
 
 
 STATIC_URL = '/static/'
+
+# Максимальная длина ленты подписок одного пользователя
+FOLLOW_TIMELINE_LENGTH = 1000
@@ -1,7 +1,8 @@
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import include, path
+from django.urls import include, path, re_path
+
+from core.views import serve_media
 
 urlpatterns = [
     # Посты
@@ -16,7 +17,12 @@ handler404 = 'core.views.page_not_found'
 handler500 = 'core.views.server_error'
 handler403 = 'core.views.permission_denied'
 
-if settings.DEBUG:
-    urlpatterns += static(
-        settings.MEDIA_URL, document_root=settings.MEDIA_ROOT
-    )
+# Медиа отдается всегда: с ETag, Range и, если настроено,
+# через X-Accel-Redirect / X-Sendfile фронтового прокси
+urlpatterns += [
+    re_path(
+        r'^{}(?P<path>.+)$'.format(settings.MEDIA_URL.lstrip('/')),
+        serve_media,
+        name='media',
+    ),
+]